@@ -0,0 +1,160 @@
+"""
+Bulk inserts for models with :class:`InheritedField` and
+:class:`CachedManyToManyField` fields (``QuerySet.bulk_create`` skips what
+``save()`` and the related managers do for them).
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+from itertools import islice, izip, repeat
+
+from django.db import connections, router
+from django.db.models import ManyToManyField
+
+from customfields.cachedmtmfield import CachedManyToManyField, CACHE_FIELD_POSTFIX, \
+                                        _default_cached_value_getter
+from customfields.inheritedfield import get_inherited_fields, _load_parents
+
+try:
+    from django.db.transaction import atomic
+except ImportError: # django < 1.6
+    from django.db.transaction import commit_on_success as atomic
+
+BULK_BATCH_SIZE = 1000
+
+__all__ = ('bulk_create', 'BULK_BATCH_SIZE')
+
+def _allocate_pks(model, count, connection):
+    "Takes `count` ids from the sequence of `model`'s primary key (PostgreSQL only)."
+    cursor = connection.cursor()
+    cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)", [
+        connection.ops.quote_name(model._meta.db_table), model._meta.pk.column, count
+    ])
+    return [row[0] for row in cursor.fetchall()]
+
+def _set_inherited(model, objs, using):
+    fields = [field for field in get_inherited_fields(model) if not field.inherit_only]
+    if not fields:
+        return
+    defaults = dict(
+        (field, model._meta.get_field(field.value_field_name).get_default()) for field in fields
+    )
+    assigned = []
+    for obj in objs:
+        for field in fields:
+            value = getattr(obj, field.value_field_name)
+            if value != defaults[field] or not getattr(obj, field.inherit_flag_name):
+                assigned.append((obj, field, value))
+                setattr(obj, field.inherit_flag_name, True) # so that its parent gets loaded
+    _load_parents(model, objs, fields, using, materialized=True)
+    for obj, field, value in assigned:
+        field.__set__(obj, value) # sets the flag like assigning the field does
+    for obj in objs:
+        for field in fields:
+            if field.materialize and getattr(obj, field.inherit_flag_name):
+                setattr(obj, field.value_field_name, field.get_value(obj))
+
+def _m2m_fields(model, memberships):
+    names = set()
+    for members in memberships:
+        if members:
+            names.update(members)
+    fields = []
+    for name in sorted(names):
+        field = model._meta.get_field(name)
+        if not isinstance(field, ManyToManyField):
+            raise TypeError("%s.%s is a %s instead of a ManyToManyField." % (
+                model.__name__, name, type(field).__name__))
+        if not field.rel.through._meta.auto_created:
+            raise TypeError("%s.%s has a custom through model, create its rows yourself." % (
+                model.__name__, name))
+        fields.append(field)
+    return fields
+
+def _target_pk(target):
+    return getattr(target, 'pk', target)
+
+def _insert_batch(model, objs, memberships, using):
+    connection = connections[using]
+    fields = _m2m_fields(model, memberships)
+    if fields:
+        missing = [obj for obj in objs if obj.pk is None]
+        if missing:
+            if connection.vendor != 'postgresql':
+                raise TypeError("bulk_create needs the primary keys of the objects with memberships "
+                                "(they are only allocated on PostgreSQL).")
+            for obj, pk in izip(missing, _allocate_pks(model, len(missing), connection)):
+                obj.pk = pk
+
+    _set_inherited(model, objs, using)
+
+    for field in fields:
+        if not isinstance(field, CachedManyToManyField):
+            continue
+        getter = field.cached_value_getter
+        if getter:
+            pks = set()
+            for members in memberships:
+                pks.update(t for t in (members or {}).get(field.name, ()) if not hasattr(t, 'pk'))
+            targets = field.rel.to._default_manager.using(using).in_bulk(list(pks)) if pks else {}
+            def cached_values(members):
+                for target in members:
+                    if not hasattr(target, 'pk'):
+                        target = targets.get(target)
+                    if target is not None:
+                        yield getter(target)
+        else:
+            def cached_values(members):
+                return (_default_cached_value_getter(target) for target in members)
+        for obj, members in izip(objs, memberships):
+            setattr(obj, field.name + CACHE_FIELD_POSTFIX,
+                    set(cached_values((members or {}).get(field.name, ()))))
+
+    model._base_manager.using(using).bulk_create(objs)
+
+    for field in fields:
+        through = field.rel.through
+        source = through._meta.get_field(field.m2m_field_name()).attname
+        target = through._meta.get_field(field.m2m_reverse_field_name()).attname
+        rows = []
+        for obj, members in izip(objs, memberships):
+            for pk in set(_target_pk(t) for t in (members or {}).get(field.name, ())):
+                rows.append(through(**{source: obj.pk, target: pk}))
+        through._base_manager.using(using).bulk_create(rows)
+
+def bulk_create(model, objs, memberships=None, batch_size=BULK_BATCH_SIZE, using=None, callback=None):
+    """
+    Inserts `objs` (new `model` instances, any iterable) `batch_size` at a
+    time, with a fixed number of queries per batch:
+
+        - the InheritedFields get what `save()` gives them: an instance whose
+          ``{fieldname}_value`` was set (isn't the default) gets
+          ``is_{fieldname}_inherited`` computed against its parent, like
+          setting the field does, the materialized ones get the parent's
+          value. The parents are loaded level by level for the whole batch.
+        - `memberships` is an iterable with a dict for each object (or None)
+          of ManyToManyField name to the related objects (or their pks). The
+          through rows are inserted with one query per field and the
+          CachedManyToManyField caches are written with the objects. This
+          needs the primary keys of the objects: set them or, on PostgreSQL,
+          they are taken from the sequence.
+
+    After each batch `callback` (if given) is called with the objects of the
+    batch. Returns the number of objects inserted.
+    """
+    using = using or router.db_for_write(model)
+    objs = iter(objs)
+    memberships = iter(memberships) if memberships is not None else repeat(None)
+    total = 0
+    while True:
+        batch = list(islice(objs, batch_size))
+        if not batch:
+            return total
+        batch_memberships = list(islice(memberships, len(batch)))
+        batch_memberships += [None] * (len(batch) - len(batch_memberships))
+        with atomic(using=using):
+            _insert_batch(model, batch, batch_memberships, using)
+        total += len(batch)
+        logger.debug("Inserted %s %s objects.", total, model.__name__)
+        if callback:
+            callback(batch)
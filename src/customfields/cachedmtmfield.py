@@ -2,47 +2,380 @@
 This module contains the :class:`CachedManyToManyField` will add a primitive ID
 cache in the model that can be accessed via fieldname.cache (preferably) or
 fieldname_cache. The cache is a :class:`SetField`.
+
+The way the set is stored in the column is pluggable (see :class:`SetCodec`).
+Values written by any of the registered codecs are recognized when read, so the
+codec of a field can be switched without migrating the existing rows.
 """
 
 from django.db.models.fields.related import ReverseManyRelatedObjectsDescriptor
-from django.db import models
+from django.db.models.fields.subclassing import Creator
+from django.db import models, connections, router
+from django.db.models import signals
+from django.db.models.query import QuerySet
+from django.db.models.fields import FieldDoesNotExist
+from django.db.backends.util import truncate_name
+from django.utils.tree import Node
+try:
+    from django.db.models.sql.constants import LOOKUP_SEP
+except ImportError:
+    from django.db.models.constants import LOOKUP_SEP
+try:
+    from django.db.transaction import atomic
+except ImportError: # django < 1.6
+    from django.db.transaction import commit_on_success as atomic
+from customfields import instrumentation
+import copy
 import pickle
-import compiler
+import base64
+import json
+import logging
+from contextlib import contextmanager
+from itertools import islice
+logger = logging.getLogger(__name__)
+try:
+    from ast import literal_eval
+except ImportError:
+    literal_eval = None
+    import compiler
 
 CACHE_FIELD_POSTFIX = '_cache'
+CACHED_OBJECTS_ATTR = '_%s_cached_objects'
+SET_LOOKUPS = ('contains', 'overlap', 'contained_by')
+LOAD_BATCH_SIZE = 500 # rows per query when filling caches for a queryset
+UPDATE_BATCH_SIZE = 300 # keeps the UPDATE below sqlite's 999 parameters limit
 
 def unrepr(s):
+    if literal_eval:
+        return literal_eval(s)
     s = "a=" + s
     p = compiler.parse(s)
     return p.getChildren()[1].getChildren()[0].getChildren()[1].value
 
+class SetCodec(object):
+    """
+    Base class for the ways a :class:`SetField` can be stored in the database.
+    Subclasses must implement:
+
+        - ``accepts(value)`` - return `True` if the database value was produced
+          by this codec. The codecs are probed with this when a row is loaded
+          so it must be cheap and must not overlap with the other codecs.
+        - ``encode(value)`` - turn the set into the database value
+        - ``decode(value)`` - turn the database value into a set
+
+    Codecs that use a database native type can also implement:
+
+        - ``db_type(connection)`` - the column type (`None` means a text column)
+        - ``lookup_sql(lookup_type, column, value, connection)`` - return the
+          ``(sql, params)`` for the `contains`, `overlap` and `contained_by`
+          lookups (see :class:`CachedManyToManyQuerySet`)
+        - ``index_sql(table, column, connection)`` - return the ``CREATE
+          INDEX`` statement that makes those lookups fast or `None`
+    """
+    name = None
+
+    def accepts(self, value):
+        raise NotImplementedError
+
+    def encode(self, value):
+        raise NotImplementedError
+
+    def decode(self, value):
+        raise NotImplementedError
+
+    def db_type(self, connection):
+        return None
+
+    def lookup_sql(self, lookup_type, column, value, connection):
+        raise TypeError("Lookup type %s not supported by the %s codec on %s." % (
+            lookup_type, self.name, connection.vendor))
+
+    def index_sql(self, table, column, connection):
+        return None
+
+class PickleCodec(SetCodec):
+    """
+    The original format: the repr of the pickled set. Slow and big but it can
+    hold anything the `cached_value_getter` returns.
+    """
+    name = 'pickle'
+
+    def accepts(self, value):
+        return value[:1] in ('"', "'")
+
+    def encode(self, value):
+        return repr(pickle.dumps(value))
+
+    def decode(self, value):
+        return pickle.loads(str(unrepr(value)))
+
+class CommaSeparatedCodec(SetCodec):
+    """
+    Sorted integers separated by commas, eg: ``"1,5,23"``. Only for integer
+    ids.
+    """
+    name = 'csv'
+
+    def accepts(self, value):
+        return value[:1] in '-0123456789'
+
+    def encode(self, value):
+        return ','.join(str(i) for i in sorted(int(i) for i in value))
+
+    def decode(self, value):
+        return set(int(i) for i in value.split(','))
+
+class VarintCodec(SetCodec):
+    """
+    Sorted integers, delta encoded as zigzag varints and then base64-ed so it
+    fits in the same text column as the other codecs. Only for integer ids.
+    """
+    name = 'varint'
+    prefix = '~'
+
+    def accepts(self, value):
+        return value[:1] == self.prefix
+
+    def encode(self, value):
+        data = bytearray()
+        last = 0
+        for i in sorted(int(i) for i in value):
+            delta = i - last
+            last = i
+            delta = (delta << 1) if delta >= 0 else ((-delta << 1) - 1)
+            while delta > 0x7f:
+                data.append((delta & 0x7f) | 0x80)
+                delta >>= 7
+            data.append(delta)
+        return self.prefix + base64.b64encode(str(data))
+
+    def decode(self, value):
+        result = set()
+        last = shift = delta = 0
+        for byte in bytearray(base64.b64decode(value[len(self.prefix):])):
+            delta |= (byte & 0x7f) << shift
+            if byte & 0x80:
+                shift += 7
+            else:
+                last += (delta >> 1) if not delta & 1 else -((delta + 1) >> 1)
+                result.add(last)
+                shift = delta = 0
+        return result
+
+def _gin_index_sql(table, column, connection):
+    qn = connection.ops.quote_name
+    return "CREATE INDEX IF NOT EXISTS %s ON %s USING gin (%s)" % ( # flush sends post_syncdb again
+        qn(truncate_name('%s_%s_gin' % (table, column), connection.ops.max_name_length())),
+        qn(table),
+        qn(column),
+    )
+
+class JsonCodec(SetCodec):
+    """
+    A JSON array of sorted integers, eg: ``"[1,5,23]"``. Stored in a ``jsonb``
+    column on PostgreSQL (GIN indexable) and in a text column elsewhere. The
+    set lookups work on PostgreSQL and SQLite (needs the JSON1 extension).
+    """
+    name = 'json'
+
+    def accepts(self, value):
+        return value[:1] == '['
+
+    def encode(self, value):
+        return json.dumps(sorted(int(i) for i in value), separators=(',', ':'))
+
+    def decode(self, value):
+        return set(json.loads(value))
+
+    def db_type(self, connection):
+        if connection.vendor == 'postgresql':
+            return 'jsonb'
+
+    def lookup_sql(self, lookup_type, column, value, connection):
+        if connection.vendor == 'postgresql':
+            if lookup_type == 'contains':
+                return "%s @> %%s::jsonb" % column, [self.encode(value)]
+            elif lookup_type == 'contained_by':
+                return "%s <@ %%s::jsonb" % column, [self.encode(value)]
+            elif lookup_type == 'overlap':
+                return "%s @> ANY (%%s::jsonb[])" % column, [[self.encode([i]) for i in value]]
+        elif connection.vendor == 'sqlite':
+            if lookup_type == 'contains':
+                return ("NOT EXISTS (SELECT 1 FROM json_each(%%s) AS needle WHERE needle.value NOT IN "
+                        "(SELECT value FROM json_each(%s)))" % column), [self.encode(value)]
+            elif lookup_type == 'contained_by':
+                return ("NOT EXISTS (SELECT 1 FROM json_each(%s) AS item WHERE item.value NOT IN "
+                        "(SELECT value FROM json_each(%%s)))" % column), [self.encode(value)]
+            elif lookup_type == 'overlap':
+                return ("EXISTS (SELECT 1 FROM json_each(%s) AS item WHERE item.value IN "
+                        "(SELECT value FROM json_each(%%s)))" % column), [self.encode(value)]
+        return super(JsonCodec, self).lookup_sql(lookup_type, column, value, connection)
+
+    def index_sql(self, table, column, connection):
+        if connection.vendor == 'postgresql':
+            return _gin_index_sql(table, column, connection)
+
+class ArrayCodec(SetCodec):
+    """
+    A native ``integer[]`` column with the ``@>``, ``&&`` and ``<@`` operators
+    for the set lookups. PostgreSQL only.
+    """
+    name = 'array'
+    operators = {
+        'contains': '@>',
+        'overlap': '&&',
+        'contained_by': '<@',
+    }
+
+    def accepts(self, value):
+        return False # the database adapter gives us lists
+
+    def encode(self, value):
+        return sorted(int(i) for i in value)
+
+    def decode(self, value):
+        return set(value)
+
+    def db_type(self, connection):
+        if connection.vendor != 'postgresql':
+            raise TypeError("The %s codec needs PostgreSQL." % self.name)
+        return 'integer[]'
+
+    def lookup_sql(self, lookup_type, column, value, connection):
+        if connection.vendor == 'postgresql' and lookup_type in self.operators:
+            return "%s %s %%s::integer[]" % (column, self.operators[lookup_type]), [self.encode(value)]
+        return super(ArrayCodec, self).lookup_sql(lookup_type, column, value, connection)
+
+    def index_sql(self, table, column, connection):
+        return _gin_index_sql(table, column, connection)
+
+CODECS = {}
+
+def register_codec(codec):
+    "Makes `codec` available by name and makes its values readable by all the SetFields."
+    CODECS[codec.name] = codec
+    return codec
+
+for _codec in (PickleCodec, CommaSeparatedCodec, VarintCodec, JsonCodec, ArrayCodec):
+    register_codec(_codec())
+
+def get_codec(codec):
+    if isinstance(codec, SetCodec):
+        return codec
+    try:
+        return CODECS[codec]
+    except KeyError:
+        raise ValueError("Unknown SetField codec %r. Available codecs: %s." % (
+            codec, ', '.join(sorted(CODECS))))
+
+class Undecoded(object):
+    "A database value of a lazy :class:`SetField` that wasn't accessed yet."
+    def __init__(self, value):
+        self.value = value
+
+class LazyCreator(Creator):
+    """
+    Like :class:`Creator` but database strings are only decoded on the first
+    access.
+    """
+    def __get__(self, obj, type=None):
+        if obj is None:
+            raise AttributeError('Can only be accessed via an instance.')
+        value = obj.__dict__[self.field.name]
+        if isinstance(value, Undecoded):
+            value = obj.__dict__[self.field.name] = self.field.to_python(value)
+        return value
+
+    def __set__(self, obj, value):
+        if isinstance(value, basestring) and value:
+            obj.__dict__[self.field.name] = Undecoded(value)
+        else:
+            obj.__dict__[self.field.name] = self.field.to_python(value)
+
 class SetField(models.TextField):
-    """ Implements a set stored as pickled object."""
+    """
+    Implements a set stored in a text column. The format is given by `codec`
+    (a :class:`SetCodec` instance or the name of a registered codec), the
+    default being the old pickle format.
+
+    With `lazy=True` the value loaded from the database is decoded only when
+    the attribute is accessed. If it's never accessed the original value is
+    saved back as it is.
 
-    __metaclass__ = models.SubfieldBase
+    With `index=True` the index given by the codec's `index_sql` (eg: a GIN
+    index for the `array` and `json` codecs on PostgreSQL) is created by
+    syncdb.
+    """
 
     def __init__(self, *args, **kwargs):
+        self.codec = get_codec(kwargs.pop('codec', PickleCodec.name))
+        self.lazy = kwargs.pop('lazy', False)
+        self.index = kwargs.pop('index', False)
         kwargs['editable'] = False #don't allow editing from admin
         #TODO: remove this: kwargs['max_length'] = 255 #this should be enough for now
         super(SetField, self).__init__(*args, **kwargs)
 
+    def contribute_to_class(self, cls, name):
+        super(SetField, self).contribute_to_class(cls, name)
+        self.stat_name = instrumentation.stat_name('setfield', cls, name)
+        setattr(cls, self.name, (LazyCreator if self.lazy else Creator)(self))
+
+    def get_value_codec(self, value):
+        "Returns the codec that wrote `value` (the field's codec is tried first)."
+        if self.codec.accepts(value):
+            return self.codec
+        for codec in CODECS.itervalues():
+            if codec.accepts(value):
+                return codec
+        raise TypeError("No codec accepts %r." % value[:20])
+
+    def db_type(self, connection):
+        return self.codec.db_type(connection) or super(SetField, self).db_type(connection)
+
     def to_python(self, value):
+        if isinstance(value, Undecoded):
+            value = value.value
         if isinstance(value, basestring) and value:
-            try:
-                return pickle.loads(str(unrepr(value)))
-            except TypeError:
-                return set()
+            # a value that doesn't decode raises: an empty set would overwrite
+            # the stored ids on the next save
+            stats = instrumentation.backend
+            if stats is None:
+                return self.get_value_codec(value).decode(value)
+            stats.incr(self.stat_name + '.decode.bytes', len(value))
+            with instrumentation.timer(stats, self.stat_name + '.decode'):
+                return self.get_value_codec(value).decode(value)
         if isinstance(value, set):
             return value
+        if isinstance(value, (list, tuple)):
+            return set(value)
         return set()
 
+    def pre_save(self, model_instance, add):
+        value = model_instance.__dict__.get(self.attname)
+        if isinstance(value, Undecoded):
+            return value
+        return super(SetField, self).pre_save(model_instance, add)
+
     def get_db_prep_value(self, value, connection=None, prepared=False):
-        if prepared:
+        if isinstance(value, Undecoded):
+            return value.value
+        if prepared or isinstance(value, basestring): # already encoded
             return value
         if not value:
             value = set()
-        r = pickle.dumps(value)
-        return repr(r)
+        stats = instrumentation.backend
+        if stats is None:
+            return self.codec.encode(value)
+        with instrumentation.timer(stats, self.stat_name + '.encode'):
+            value = self.codec.encode(value)
+        stats.incr(self.stat_name + '.encode.bytes', len(value))
+        return value
+
+    def get_set_lookup_sql(self, lookup_type, value, connection, alias=None):
+        "Returns the ``(sql, params)`` for one of the `SET_LOOKUPS` (`alias` is the quoted table alias)."
+        qn = connection.ops.quote_name
+        column = "%s.%s" % (alias or qn(self.model._meta.db_table), qn(self.column))
+        return self.codec.lookup_sql(lookup_type, column, value, connection)
 
     def get_prep_lookup(self, lookup_type, value):
         raise TypeError("Lookup type %s not supported." % lookup_type)
@@ -53,31 +386,108 @@ class SetField(models.TextField):
 def _default_cached_value_getter(o):
     return int(o) if isinstance(o, (int, str, unicode)) else o.pk
 
-def get_caching_related_manager(superclass, instance, field_name, related_name, cache_field_name, cached_value_getter):
-    "Creates a new manager class that has some extra (synchronizing the cache field) handling."
-    cached_value_getter = cached_value_getter or _default_cached_value_getter
-
-    class CachingRelatedManager(superclass):
-        def add(self, *objs):
-            super(CachingRelatedManager, self).add(*objs)
-            cached_field = getattr(instance, cache_field_name)
-            cached_field.update(cached_value_getter(o) for o in objs)
-
-        def remove(self, *objs):
-            super(CachingRelatedManager, self).remove(*objs)
-            cached_field = getattr(instance, cache_field_name)
-            cached_field.symmetric_difference_update(cached_value_getter(o) for o in objs)
-
-        def clear(self):
-            super(CachingRelatedManager, self).clear()
-            cached_field = getattr(instance, cache_field_name)
+class CachingRelatedManagerMixin(object):
+    """
+    The extra (synchronizing the cache field) handling for the related manager.
+    The per-field settings are class attributes (see
+    :func:`get_caching_related_manager`) and the owner is the manager's
+    `instance`.
+    """
+    field_name = None
+    cache_field_name = None
+    cached_value_getter = staticmethod(_default_cached_value_getter)
+    autosave_cache = False
+    atomic_cache = False
+
+    def add(self, *objs):
+        with self.cache_lock():
+            super(CachingRelatedManagerMixin, self).add(*objs)
+            cached_field = getattr(self.instance, self.cache_field_name)
+            cached_field.update(self.cached_value_getter(o) for o in objs)
+            self.record_stat('add', len(objs))
+            self.instance.__dict__.pop(CACHED_OBJECTS_ATTR % self.field_name, None)
+            if self.autosave_cache or self.atomic_cache:
+                self.save_cache()
+
+    def remove(self, *objs):
+        with self.cache_lock():
+            super(CachingRelatedManagerMixin, self).remove(*objs)
+            cached_field = getattr(self.instance, self.cache_field_name)
+            cached_field.difference_update(self.cached_value_getter(o) for o in objs)
+            self.record_stat('remove', len(objs))
+            self.instance.__dict__.pop(CACHED_OBJECTS_ATTR % self.field_name, None)
+            if self.autosave_cache or self.atomic_cache:
+                self.save_cache()
+
+    def clear(self):
+        with self.cache_lock():
+            super(CachingRelatedManagerMixin, self).clear()
+            cached_field = getattr(self.instance, self.cache_field_name)
             cached_field.clear()
+            self.record_stat('clear')
+            self.instance.__dict__.pop(CACHED_OBJECTS_ATTR % self.field_name, None)
+            if self.autosave_cache or self.atomic_cache:
+                self.save_cache()
 
-        @property
-        def cache(self):
-            return getattr(instance, cache_field_name)
+    def record_stat(self, event, count=1):
+        stats = instrumentation.backend
+        if stats is not None:
+            stats.incr(instrumentation.stat_name(
+                'cachedm2m', self.instance.__class__, self.field_name
+            ) + '.' + event, count)
 
-    return CachingRelatedManager
+    @contextmanager
+    def cache_lock(self):
+        """
+        If `atomic_cache` is set this locks the owner's row (``SELECT ... FOR
+        UPDATE``) and reloads the cache from it for the duration of the block.
+        """
+        if not self.atomic_cache:
+            yield
+            return
+        owner = self.instance
+        using = router.db_for_write(owner.__class__, instance=owner)
+        with atomic(using=using):
+            value = owner.__class__._base_manager.using(using).select_for_update().filter(
+                pk=owner.pk
+            ).values_list(self.cache_field_name, flat=True).get()
+            setattr(owner, self.cache_field_name, owner._meta.get_field(self.cache_field_name).to_python(value))
+            yield
+
+    def save_cache(self):
+        "Saves only the cache column of the owner."
+        owner = self.instance
+        owner.__class__._base_manager.using(
+            router.db_for_write(owner.__class__, instance=owner)
+        ).filter(pk=owner.pk).update(**{
+            self.cache_field_name: getattr(owner, self.cache_field_name)
+        })
+
+    @property
+    def cache(self):
+        return getattr(self.instance, self.cache_field_name)
+
+    @property
+    def cached_objects(self):
+        """
+        The objects for the ids in the cache, ordered by id. Use
+        :func:`resolve_m2m_cache` to get them for many instances at once.
+        """
+        attr = CACHED_OBJECTS_ATTR % self.field_name
+        if attr not in self.instance.__dict__:
+            resolve_m2m_cache([self.instance], [self.field_name])
+        return self.instance.__dict__[attr]
+
+def get_caching_related_manager(superclass, field_name, related_name, cache_field_name, cached_value_getter,
+                                autosave_cache=False, atomic_cache=False):
+    "Creates a new manager class that has some extra (synchronizing the cache field) handling."
+    return type('CachingRelatedManager', (CachingRelatedManagerMixin, superclass), {
+        'field_name': field_name,
+        'cache_field_name': cache_field_name,
+        'cached_value_getter': staticmethod(cached_value_getter or _default_cached_value_getter),
+        'autosave_cache': autosave_cache,
+        'atomic_cache': atomic_cache,
+    })
 
 
 class CachedReverseManyRelatedObjectsDescriptor(ReverseManyRelatedObjectsDescriptor):
@@ -85,18 +495,32 @@ class CachedReverseManyRelatedObjectsDescriptor(ReverseManyRelatedObjectsDescrip
         super(CachedReverseManyRelatedObjectsDescriptor, self).__init__(field)
         self.cache_field_name = cache_field_name
         self.cached_value_getter = cached_value_getter
+        self.manager_superclass = self.manager_class = None
+
+    def get_manager_class(self, superclass):
+        """
+        Returns the caching subclass of `superclass`. Only the last one is kept:
+        newer Django versions use the same related manager class for all the
+        accesses while older ones make a new class each time (and keeping all
+        those would leak).
+        """
+        if superclass is not self.manager_superclass:
+            self.manager_class = get_caching_related_manager(superclass,
+                                                             self.field.name,
+                                                             self.field.rel.related_name,
+                                                             self.cache_field_name,
+                                                             self.cached_value_getter,
+                                                             self.field.autosave_cache,
+                                                             self.field.atomic_cache)
+            self.manager_superclass = superclass
+        return self.manager_class
 
     def __get__(self, instance, cls=None):
         manager = super(CachedReverseManyRelatedObjectsDescriptor, self).__get__(instance, cls)
+        if instance is None:
+            return manager
 
-        CachingRelatedManager = get_caching_related_manager(manager.__class__,
-                                                            instance,
-                                                            self.field.name,
-                                                            self.field.rel.related_name,
-                                                            self.cache_field_name,
-                                                            self.cached_value_getter)
-
-        manager.__class__ = CachingRelatedManager
+        manager.__class__ = self.get_manager_class(manager.__class__)
         return manager
 
 class CachedManyToManyField(models.ManyToManyField):
@@ -104,15 +528,456 @@ class CachedManyToManyField(models.ManyToManyField):
     This field will add a primitive ID cache in the model that can be accessed
     via fieldname.cache (preferably) or fieldname_cache. The cache is a
     :class:`SetField`.
+
+    Use `cache_codec` to choose the storage format of the cache (see
+    :class:`SetCodec`), `lazy_cache=True` to only decode it when it's
+    accessed and `cache_index=True` to create the codec's index for the set
+    lookups (see :class:`CachedManyToManyQuerySet`).
+
+    With `sync_cache=True` the cache column is recomputed in the database for
+    all the rows affected by any change of the relation (including changes
+    made from the other side of the relation or from other instances).
+
+    With `autosave_cache=True` the manager's add/remove/clear also save the
+    cache column (and only that column) of the owner.
+
+    With `atomic_cache=True` the changes are also saved but the owner's row is
+    locked and the cache reloaded from it first, so concurrent changes on
+    the same owner don't overwrite each other's ids.
     """
-    def __init__(self, to, cached_value_getter=None, **kwargs):
+    def __init__(self, to, cached_value_getter=None, cache_codec=PickleCodec.name, lazy_cache=False,
+                 sync_cache=False, autosave_cache=False, atomic_cache=False, cache_index=False, **kwargs):
         super(CachedManyToManyField, self).__init__(to, **kwargs)
         self.cached_value_getter = cached_value_getter
+        self.cache_codec = cache_codec
+        self.lazy_cache = lazy_cache
+        self.sync_cache = sync_cache
+        self.autosave_cache = autosave_cache
+        self.atomic_cache = atomic_cache
+        self.cache_index = cache_index
 
     def contribute_to_class(self, cls, name):
         super(CachedManyToManyField, self).contribute_to_class(cls, name)
         cache_field_name = name + CACHE_FIELD_POSTFIX
         if not cls._meta.abstract:
-            set_field = SetField()
+            set_field = SetField(codec=self.cache_codec, lazy=self.lazy_cache, index=self.cache_index)
             set_field.contribute_to_class(cls, cache_field_name)
             setattr(cls, name, CachedReverseManyRelatedObjectsDescriptor(self, cache_field_name, self.cached_value_getter))
+            if self.sync_cache:
+                SYNCED_FIELDS.append(self)
+
+
+class RawSubquery(object):
+    "A subquery given as sql, usable as the value of an ``__in`` lookup."
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+
+    def prepare(self):
+        return self
+
+    def _as_sql(self, connection):
+        return self.sql, self.params
+
+class CachedManyToManyQuerySet(QuerySet):
+    """
+    Adds the `contains`, `overlap` and `contained_by` lookups for the cache
+    fields (if the codec supports them), eg::
+
+        Model.objects.filter(m2mrel_cache__contains=[5])
+
+    In the keyword arguments of `filter` and `exclude` they are added to the
+    ``WHERE`` as they are, in :class:`Q` objects (and `get`) they become
+    ``pk IN (SELECT ...)`` subqueries.
+
+    Use :meth:`with_m2m_cache` to (re)load the caches from the through tables
+    and :meth:`with_m2m_objects` to get the cached objects while iterating.
+    """
+    _m2m_cache_fields = ()
+    _m2m_object_fields = ()
+
+    def with_m2m_cache(self, *field_names):
+        """
+        Fills the caches of the given fields from the through tables for all
+        the returned objects, with one query per field for every
+        `LOAD_BATCH_SIZE` objects (instead of a ``obj.field.all()`` per row).
+        """
+        for name in field_names:
+            get_cached_field(self.model, name)
+        return self._clone(_m2m_cache_fields=self._m2m_cache_fields + field_names)
+
+    def with_m2m_objects(self, *field_names):
+        """
+        Resolves the caches of the given fields to objects (see
+        :func:`resolve_m2m_cache`) for every `LOAD_BATCH_SIZE` objects. The
+        objects are shared between the rows of the whole iteration.
+        """
+        for name in field_names:
+            get_cached_field(self.model, name)
+        return self._clone(_m2m_object_fields=self._m2m_object_fields + field_names)
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('_m2m_cache_fields', self._m2m_cache_fields)
+        kwargs.setdefault('_m2m_object_fields', self._m2m_object_fields)
+        return super(CachedManyToManyQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def iterator(self):
+        objs = super(CachedManyToManyQuerySet, self).iterator()
+        if self._m2m_cache_fields or self._m2m_object_fields:
+            objs = self._load_m2m_caches(objs)
+        return objs
+
+    def _load_m2m_caches(self, objs):
+        identity_map = {}
+        while True:
+            batch = list(islice(objs, LOAD_BATCH_SIZE))
+            if not batch:
+                return
+            if self._m2m_cache_fields:
+                load_m2m_caches(batch, self._m2m_cache_fields, self.db)
+            if self._m2m_object_fields:
+                resolve_m2m_cache(batch, self._m2m_object_fields, self.db, identity_map)
+            for obj in batch:
+                yield obj
+
+    def _get_set_lookup(self, key):
+        "Returns ``(field, lookup_type)`` if `key` is a set lookup on a SetField, None otherwise."
+        parts = key.split(LOOKUP_SEP)
+        if len(parts) != 2 or parts[1] not in SET_LOOKUPS:
+            return None
+        try:
+            field = self.model._meta.get_field(parts[0], many_to_many=False)
+        except FieldDoesNotExist:
+            return None
+        if isinstance(field, SetField):
+            return field, parts[1]
+
+    def _pop_set_lookups(self, kwargs):
+        where, params = [], []
+        for key in kwargs.keys():
+            lookup = self._get_set_lookup(key)
+            if lookup:
+                sql, lookup_params = lookup[0].get_set_lookup_sql(lookup[1], kwargs.pop(key), connections[self.db])
+                where.append(sql)
+                params.extend(lookup_params)
+        return where, params
+
+    def _rewrite_set_lookups(self, q):
+        "Returns `q` (a :class:`Q` tree) with the set lookups replaced by ``pk__in`` subqueries."
+        children = []
+        changed = False
+        for child in q.children:
+            if isinstance(child, Node):
+                new_child = self._rewrite_set_lookups(child)
+            else:
+                key, value = child
+                lookup = self._get_set_lookup(key)
+                if lookup is None:
+                    new_child = child
+                else:
+                    field, lookup_type = lookup
+                    new_child = ('pk__in', self._set_lookup_subquery(field, lookup_type, value))
+            changed = changed or new_child is not child
+            children.append(new_child)
+        if not changed:
+            return q
+        q = copy.copy(q)
+        q.children = children
+        return q
+
+    def _set_lookup_subquery(self, field, lookup_type, value):
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        alias = qn('set_lookup')
+        sql, params = field.get_set_lookup_sql(lookup_type, value, connection, alias)
+        return RawSubquery("SELECT %s.%s FROM %s %s WHERE %s" % (
+            alias, qn(self.model._meta.pk.column), qn(self.model._meta.db_table), alias, sql
+        ), params)
+
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        args = [self._rewrite_set_lookups(q) for q in args]
+        return super(CachedManyToManyQuerySet, self)._filter_or_exclude(negate, *args, **kwargs)
+
+    def filter(self, *args, **kwargs):
+        where, params = self._pop_set_lookups(kwargs)
+        qs = super(CachedManyToManyQuerySet, self).filter(*args, **kwargs)
+        if where:
+            qs = qs.extra(where=where, params=params)
+        return qs
+
+    def exclude(self, *args, **kwargs):
+        original_kwargs = kwargs.copy()
+        where, params = self._pop_set_lookups(kwargs)
+        if not where:
+            return super(CachedManyToManyQuerySet, self).exclude(*args, **kwargs)
+        if args or kwargs:
+            return self.exclude(pk__in=self.filter(*args, **original_kwargs).values('pk'))
+        return self.extra(where=["NOT (%s)" % " AND ".join(where)], params=params)
+
+class CachedManyToManyManager(models.Manager):
+    def get_query_set(self):
+        return CachedManyToManyQuerySet(self.model, using=self._db)
+
+    def with_m2m_cache(self, *field_names):
+        return self.get_query_set().with_m2m_cache(*field_names)
+
+    def with_m2m_objects(self, *field_names):
+        return self.get_query_set().with_m2m_objects(*field_names)
+
+def create_set_field_indexes(sender, created_models, db, **kwargs):
+    "Creates the indexes for the SetFields with `index=True` (syncdb doesn't know about them)."
+    connection = connections[db]
+    for model in created_models:
+        if models.get_app(model._meta.app_label) is not sender:
+            continue # the signal is sent for each app with all the created models
+        for field in model._meta.local_fields:
+            if isinstance(field, SetField) and field.index:
+                sql = field.codec.index_sql(model._meta.db_table, field.column, connection)
+                if sql:
+                    connection.cursor().execute(sql)
+
+signals.post_syncdb.connect(create_set_field_indexes)
+
+def get_cached_field(model, field_name):
+    field = model._meta.get_field(field_name)
+    if not isinstance(field, CachedManyToManyField):
+        raise TypeError("%s.%s is a %s instead of a CachedManyToManyField." % (
+            model.__name__, field_name, type(field).__name__))
+    return field
+
+def fetch_cache_values(field, pks, using=None):
+    """
+    Reads the cache values for the owners in `pks` from the through table of
+    `field` (a :class:`CachedManyToManyField`) with a single query. Returns a
+    dict with a set for every pk in `pks`.
+    """
+    through = field.rel.through
+    source_name = field.m2m_field_name()
+    values = dict((pk, set()) for pk in pks)
+    if not values:
+        return values
+    rows = through._default_manager.using(using).filter(**{
+        '%s__in' % source_name: list(values)
+    }).values_list(source_name, field.m2m_reverse_field_name())
+
+    if field.cached_value_getter:
+        rows = list(rows)
+        objs = field.rel.to._default_manager.using(using).in_bulk(set(target for _, target in rows))
+        for owner, target in rows:
+            if target in objs:
+                values[owner].add(field.cached_value_getter(objs[target]))
+    else:
+        for owner, target in rows:
+            values[owner].add(target)
+    return values
+
+def load_m2m_caches(instances, field_names, using=None):
+    """
+    Sets the caches of `field_names` on `instances` (all of the same model)
+    from the through tables, with one query per field.
+    """
+    if not instances:
+        return
+    model = instances[0].__class__
+    pks = [obj.pk for obj in instances]
+    for name in field_names:
+        field = get_cached_field(model, name)
+        values = fetch_cache_values(field, pks, using)
+        cache_field_name = name + CACHE_FIELD_POSTFIX
+        for obj in instances:
+            setattr(obj, cache_field_name, values[obj.pk])
+
+def resolve_m2m_cache(instances, field_names, using=None, identity_map=None):
+    """
+    Resolves the ids in the caches of `field_names` on `instances` (all of the
+    same model) to objects, available after this via
+    ``instance.field.cached_objects``.
+
+    The objects are loaded with one ``in_bulk`` query per target model (fields
+    pointing to the same model share it) and an object is loaded only once, no
+    matter how many instances have it in the cache. Pass the same
+    `identity_map` (a dict, returned by this function) to reuse the objects
+    between calls.
+    """
+    if identity_map is None:
+        identity_map = {}
+    if not instances:
+        return identity_map
+    model = instances[0].__class__
+    fields = [get_cached_field(model, name) for name in field_names]
+    wanted = {}
+    for field in fields:
+        if field.cached_value_getter:
+            raise TypeError("Can't resolve %s.%s: the cache doesn't contain primary keys (it has a "
+                            "cached_value_getter)." % (model.__name__, field.name))
+        ids = wanted.setdefault(field.rel.to, set())
+        for obj in instances:
+            ids.update(getattr(obj, field.name + CACHE_FIELD_POSTFIX))
+
+    for target, ids in wanted.iteritems():
+        known = identity_map.setdefault(target, {})
+        missing = [pk for pk in ids if pk not in known]
+        if missing:
+            known.update(target._default_manager.using(using).in_bulk(missing))
+
+    for field in fields:
+        known = identity_map[field.rel.to]
+        attr = CACHED_OBJECTS_ATTR % field.name
+        for obj in instances:
+            obj.__dict__[attr] = [
+                known[pk] for pk in sorted(getattr(obj, field.name + CACHE_FIELD_POSTFIX)) if pk in known
+            ]
+    return identity_map
+
+def write_cache_values(model, field, values, using=None):
+    """
+    Writes `values` (a dict of pk to set) in the cache column of `field` with
+    batched ``UPDATE ... SET column = CASE pk WHEN ... END`` statements.
+    """
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cache_field = model._meta.get_field(field.name + CACHE_FIELD_POSTFIX)
+    pk_column = qn(model._meta.pk.column)
+    placeholder = "%s"
+    if connection.vendor == 'postgresql':
+        placeholder = "%%s::%s" % cache_field.db_type(connection)
+    items = values.items()
+    with atomic(using=using):
+        cursor = connection.cursor()
+        for start in range(0, len(items), UPDATE_BATCH_SIZE):
+            batch = items[start:start + UPDATE_BATCH_SIZE]
+            params = []
+            for pk, value in batch:
+                params.extend((pk, cache_field.get_db_prep_save(value, connection=connection)))
+            params.extend(pk for pk, _ in batch)
+            cursor.execute("UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)" % (
+                qn(model._meta.db_table),
+                qn(cache_field.column),
+                pk_column,
+                ' '.join(["WHEN %s THEN " + placeholder] * len(batch)),
+                pk_column,
+                ', '.join(["%s"] * len(batch)),
+            ), params)
+
+def iter_pk_chunks(model, chunk_size, start_pk=None, using=None):
+    "Yields lists of at most `chunk_size` primary keys, in order, starting from `start_pk`."
+    qs = model._base_manager.using(using).order_by('pk')
+    if start_pk is not None:
+        qs = qs.filter(pk__gte=start_pk)
+    while True:
+        pks = list(qs.values_list('pk', flat=True)[:chunk_size])
+        if not pks:
+            return
+        yield pks
+        qs = qs.filter(pk__gt=pks[-1])
+
+def sync_cache(model, field_name, pks, using=None):
+    """
+    Recomputes the cache of `field_name` for the rows in `pks` from the through
+    table. Use this after changing the through table directly (eg: a
+    ``bulk_create`` on the through model). Returns the new values.
+    """
+    field = get_cached_field(model, field_name)
+    values = fetch_cache_values(field, pks, using)
+    write_cache_values(model, field, values, using)
+    return values
+
+def rebuild_chunk(model, field_name, pks, using=None):
+    "Recomputes the cache of `field_name` for the rows in `pks` from the through table."
+    sync_cache(model, field_name, pks, using)
+    return pks[-1]
+
+def _rebuild_chunk_worker(args):
+    app_label, model_name, field_name, pks, using = args
+    return rebuild_chunk(models.get_model(app_label, model_name), field_name, pks, using)
+
+def _close_connections():
+    for connection in connections.all():
+        connection.close()
+
+def rebuild_cache(model, field_name, chunk_size=1000, start_pk=None, workers=1, using=None, callback=None):
+    """
+    Recomputes the cache of the :class:`CachedManyToManyField` `field_name` on
+    all the rows of `model` from the through table. Useful after raw sql
+    changes, loaddata or adding the field on an existing model.
+
+    The rows are processed in primary key order, in chunks of `chunk_size`.
+    After each chunk `callback` (if given) is called with the last pk that was
+    rebuilt so an interrupted rebuild can be resumed with `start_pk`. With
+    `workers > 1` the chunks are processed in parallel by that many processes
+    (the callback still gets the pks in order).
+
+    Returns the last pk that was rebuilt.
+    """
+    get_cached_field(model, field_name)
+    using = using or router.db_for_write(model)
+    chunks = iter_pk_chunks(model, chunk_size, start_pk, using)
+    last_pk = None
+    if workers > 1:
+        import multiprocessing
+        _close_connections() # the worker processes must not share our connections
+        pool = multiprocessing.Pool(workers, initializer=_close_connections)
+        try:
+            results = pool.imap(_rebuild_chunk_worker, (
+                (model._meta.app_label, model._meta.object_name, field_name, pks, using)
+                for pks in chunks
+            ))
+            for last_pk in results:
+                if callback:
+                    callback(last_pk)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for pks in chunks:
+            last_pk = rebuild_chunk(model, field_name, pks, using)
+            if callback:
+                callback(last_pk)
+    logger.debug("Rebuilt %s.%s cache up to pk %s.", model.__name__, field_name, last_pk)
+    return last_pk
+
+SYNCED_FIELDS = []
+
+def sync_m2m_changed(sender, instance, action, reverse, pk_set, using, **kwargs):
+    """
+    Keeps the caches of the fields with `sync_cache=True` in sync with the
+    through table: the affected owners are recomputed with one query and written
+    with a batched update.
+    """
+    for field in SYNCED_FIELDS:
+        if field.rel.through is sender:
+            break
+    else:
+        return
+
+    pending_name = '_%s_pending_owners' % field.name
+    if reverse:
+        if action == 'pre_clear':
+            instance.__dict__[pending_name] = list(sender._default_manager.using(using).filter(**{
+                field.m2m_reverse_field_name(): instance.pk
+            }).values_list(field.m2m_field_name(), flat=True))
+            return
+        elif action == 'post_clear':
+            owners = instance.__dict__.pop(pending_name, ())
+        elif action in ('post_add', 'post_remove'):
+            owners = pk_set
+        else:
+            return
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        owners = [instance.pk]
+    else:
+        return
+
+    if owners:
+        stats = instrumentation.backend
+        if stats is not None:
+            stats.incr(instrumentation.stat_name('cachedm2m', field.model, field.name) + '.sync', len(owners))
+        values = sync_cache(field.model, field.name, owners, using)
+        if not reverse:
+            setattr(instance, field.name + CACHE_FIELD_POSTFIX, values[instance.pk])
+
+signals.m2m_changed.connect(sync_m2m_changed)
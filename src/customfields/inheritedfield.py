@@ -2,28 +2,51 @@ import logging
 logger = logging.getLogger(__name__)
 
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Model, Field, BooleanField, Manager, ManyToManyField, Q
+from django.db.models.fields import FieldDoesNotExist
+from django.db import connections, DatabaseError
+from django.db.backends.util import truncate_name
+from django.utils.datastructures import SortedDict
+from django.db.models import get_app, get_model, Model, Field, BooleanField, Manager, ManyToManyField, Q
 from django.db.models.query import QuerySet
 from django.db.models.fields.related import RelatedField, add_lazy_relation, \
                         ReverseManyRelatedObjectsDescriptor, ManyToManyField
 from django.db.models.base import ModelBase
 from django.db.models import signals
-from django.db.models.sql.constants import QUERY_TERMS
+try:
+    from django.db.transaction import atomic
+except ImportError: # django < 1.6
+    from django.db.transaction import commit_on_success as atomic
 try:
     from django.db.models.sql.constants import LOOKUP_SEP
 except ImportError:
     from django.db.models.constants import LOOKUP_SEP
 from django.utils.functional import curry
+from django.utils.tree import Node
+
+from customfields import instrumentation
+from customfields.cachedmtmfield import _close_connections
 
 import copy
+import operator
 from collections import defaultdict
+from itertools import islice
 
 INHERIT_FLAG_NAME = "is_%s_inherited"
 VALUE_FIELD_NAME = "%s_value"
+INHERITED_MEMO_ATTR = "_inherited_memo"
+NOT_MEMOIZED = object() # see InheritedField.recall
+EFFECTIVE_VALUE_NAME = "%s_effective"
+RESOLVE_BATCH_SIZE = 500 # rows per batch in InheritedFieldQuerySet.resolve_inherited
 
 __all__ = (
     'INHERIT_FLAG_NAME', 'VALUE_FIELD_NAME', 'InheritedOnlyException',
-    'InheritedField', 'find_in_parent', 'find_on_model'
+    'InheritedField', 'find_in_parent', 'find_on_model', 'get_inherited_fields',
+    'resolve_inherited', 'inherited_value_sql', 'EFFECTIVE_VALUE_NAME',
+    'get_inheritance_paths', 'get_inheritance_columns', 'InheritedFieldQuerySet',
+    'InheritedFieldManager', 'propagate_inherited', 'record_change', 'drain_journal',
+    'InheritanceNode', 'get_inheritance_graph', 'get_inheritance_node',
+    'get_lookup_branches', 'rewrite_q', 'inherited_index_sql', 'forget_inherited',
+    'record_changes', 'propagate_changes'
 )
 
 class InheritedOnlyException(Exception):
@@ -49,34 +72,103 @@ class InheritedField(Field):
         - set will raise `InheritedOnlyException` if the field is `inherit_only`
         - set will save the value in `{fieldname}_value` and set the
           `is_{fieldname}_inherited` flag accordingly
+
+    With `materialize=True` the inherited value is also stored in
+    `{fieldname}_value` (when the instance is saved and, for all the inheriting
+    rows, when the parent is saved - see :func:`propagate_inherited`) and get
+    returns it without touching the parent. With `journal=True` saving the
+    parent only records the change in the journal, the inheriting rows are
+    updated later by :func:`drain_journal`.
+
+    With `index=True` an index on ``(is_{fieldname}_inherited,
+    {fieldname}_value)`` (just ``{fieldname}_value`` if materialized) is added
+    to ``Meta.index_together`` (created by syncdb on django < 1.5, that
+    doesn't have it, see :func:`inherited_index_sql`). With `index='partial'` a partial index on
+    ``{fieldname}_value WHERE NOT is_{fieldname}_inherited`` is created by
+    syncdb instead (PostgreSQL only, see :func:`inherited_index_sql` for
+    the other databases and for migrations).
+
+    With `memoize=True` the inherited value (and display) is kept on the
+    instance after the first read and used as long as the
+    `is_{fieldname}_inherited` flag and the parent id stay the same (set
+    clears it too). Changes made to the parent object after that aren't seen,
+    use :func:`forget_inherited` if needed.
     """
-    def __init__(self, parent_name, field_name=None, inherit_only=False, validate=True):
+    def __init__(self, parent_name, field_name=None, inherit_only=False, validate=True, materialize=False,
+                 journal=False, index=False, memoize=False):
         super(InheritedField, self).__init__()
 
+        if inherit_only and materialize:
+            raise TypeError("InheritedField: can't materialize an inherit_only field.")
+        if journal and not materialize:
+            raise TypeError("InheritedField: journal=True requires materialize=True.")
+        if index not in (False, True, 'partial'):
+            raise TypeError("InheritedField: index must be True, False or 'partial', not %r." % (index,))
+        if index and inherit_only:
+            raise TypeError("InheritedField: can't index an inherit_only field.")
         self.parent_object_field_name = parent_name
         self.inherited_field_name_in_parent = field_name
         self.inherit_only = inherit_only
         self.validate = validate
+        self.materialize = materialize
+        self.journal = journal
+        self.index = index
+        self.memoize = memoize
 
     def get_field_display(self, instance, name):
-        if self.inherit_only or getattr(instance, self.inherit_flag_name):
-            rel = getattr(instance, self.parent_object_field_name)
-            pname = self.inherited_field_name_in_parent or name
-            displayfname = "get_%s_display" % pname
-            return u"%s *Inherited" % (
-                getattr(rel, displayfname)()
-                if hasattr(rel, displayfname)
-                else getattr(rel, pname)
-            )
+        value = self.recall(instance, (name, 'display'))
+        if value is not NOT_MEMOIZED:
+            return value
+        if self.memoize:
+            return self.get_memoized(instance, (name, 'display'), self.compute_field_display)
+        return self.compute_field_display(instance)
+
+    def get_display_table(self):
+        "Returns the choices of the field the value comes from as a value -> label dict."
+        try:
+            return self._display_table
+        except AttributeError:
+            table = {}
+            terminal_field = get_inheritance_node(self.model, self.name).terminal_field
+            for value, label in getattr(terminal_field, '_choices', None) or ():
+                if isinstance(label, (list, tuple)): # a group
+                    table.update(label)
+                else:
+                    table[value] = label
+            self._display_table = table
+            return table
+
+    def compute_field_display(self, instance):
+        """
+        The label of the value, followed by an `` *Inherited`` for every level
+        it's inherited through.
+        """
+        field, obj, levels = self, instance, 0
+        while field.inherit_only or getattr(obj, field.inherit_flag_name):
+            parent = getattr(obj, field.parent_object_field_name)
+            levels += 1
+            node = get_inheritance_node(field.model, field.name)
+            if node.parent_node is None:
+                value = getattr(parent, node.target_name)
+                break
+            field, obj = node.parent_node.field, parent
         else:
-            return getattr(instance, VALUE_FIELD_NAME % name)
+            value = getattr(obj, field.value_field_name)
+        table = self.get_display_table()
+        if table:
+            value = table.get(value, value)
+        if levels:
+            return u"%s%s" % (value, u" *Inherited" * levels)
+        return value
 
     def contribute_to_class(self, cls, name):
         self.name = self.attname = name
+        self.model = cls
         cls._meta.add_virtual_field(self)
 
         self.inherit_flag_name = INHERIT_FLAG_NAME % name
         self.value_field_name = VALUE_FIELD_NAME % name
+        self.stat_name = instrumentation.stat_name('inherited', cls, name)
 
         if not self.inherit_only:
             flag_field = BooleanField(default=True)
@@ -86,11 +178,11 @@ class InheritedField(Field):
             # cls.add_to_class(self.inherit_flag_name, flag_field)
             flag_field.contribute_to_class(cls, self.inherit_flag_name)
 
-            signals.class_prepared.connect(
-                curry(self.add_value_field, name=name),
-                sender=cls,
-                weak=False
-            )
+            if self.index is True and hasattr(cls._meta, 'index_together'): # django >= 1.5
+                cls._meta.index_together = list(cls._meta.index_together) + [
+                    (self.value_field_name,) if self.materialize else (self.inherit_flag_name, self.value_field_name)
+                ]
+
 
         setattr(cls, name, self)
         display_name = 'get_%s_display' % name
@@ -101,9 +193,21 @@ class InheritedField(Field):
             cls.FIELD_INHERITANCE_MAP = {}
 
         cls.FIELD_INHERITANCE_MAP[name] = (self.parent_object_field_name, self.inherited_field_name_in_parent or name)
-        signals.class_prepared.connect(self.patch_manager, sender=cls)
+        _pending_fields[cls].append(self) # see prepare_inherited_fields
+
+        if self.materialize:
+            MATERIALIZED_FIELDS.append(self)
+            _materialized_children.clear()
+        _inheritance_graphs.clear()
 
     def patch_manager(self, sender, **kwargs):
+        """
+        Makes the default manager's querysets `select_related` all the parents
+        needed by the inherited fields. Not done for :class:`InheritedFieldManager`
+        managers: use :meth:`InheritedFieldQuerySet.select_inherited` with them.
+        """
+        if isinstance(sender.objects, InheritedFieldManager):
+            return
         if not hasattr(sender.objects, 'original_get_query_set'):
             _get_query_set = sender.objects.get_query_set
             def get_query_set(qs):
@@ -112,12 +216,7 @@ class InheritedField(Field):
                 if hasattr(model, 'FIELD_INHERITANCE_REL'):
                     related = model.FIELD_INHERITANCE_REL
                 else:
-                    related = set()
-                    for field, (parent, target_field) in model.FIELD_INHERITANCE_MAP.iteritems():
-                        chain = []
-                        find_in_parent(model, parent, target_field, validate=False, chain=chain)
-                        related.add('__'.join(chain))
-                    model.FIELD_INHERITANCE_REL = related
+                    related = model.FIELD_INHERITANCE_REL = get_inheritance_paths(model)
 
                 return _get_query_set().select_related(*related)
 
@@ -134,12 +233,16 @@ class InheritedField(Field):
             if isinstance(field, ReverseManyRelatedObjectsDescriptor):
                 field = field.field
 
-            xfield = copy.deepcopy(field)
+            xfield = clone_field(field)
+            xfield.name = xfield.db_column = None # or else django 1.6+ keeps the parent's name
             xfield.blank = True
             if isinstance(xfield, ManyToManyField):
                 xfield.rel.through = None
 
-            xfield.creation_counter = self.creation_counter
+            # a counter of its own: fields compare (and hash) by it so sharing
+            # it with the flag field breaks things like `only()`
+            xfield.creation_counter = Field.creation_counter
+            Field.creation_counter += 1
             xfield.contribute_to_class(sender, VALUE_FIELD_NAME % name)
 
         value_field = find_in_parent(
@@ -149,18 +252,92 @@ class InheritedField(Field):
             robust and self.validate,
             callback = contribute
         )
+        if value_field:
+            # the parent was already there (otherwise `contribute` is called
+            # when it's resolved)
+            contribute(value_field)
+
     def __get__(self, instance, instance_type=None):
+        stats = instrumentation.backend
+        if stats is not None:
+            stats.incr(self.stat_name + '.hit')
+        if self.materialize and not instance._state.adding:
+            return getattr(instance, self.value_field_name, None)
+        value = self.recall(instance, self.name)
+        if value is not NOT_MEMOIZED:
+            return value
+        if self.memoize:
+            return self.get_memoized(instance, self.name, self.get_value)
+        return self.get_value(instance)
+
+    def get_memoized(self, instance, key, compute):
+        "Returns `compute(instance)`, memoized under `key` while it's inherited from the same parent."
+        value = self.recall(instance, key)
+        if value is NOT_MEMOIZED:
+            value = compute(instance)
+            self.remember(instance, key, value)
+        return value
+
+    def get_parent_id(self, instance):
+        try:
+            parent_attname = self.parent_attname
+        except AttributeError:
+            parent_attname = self.parent_attname = self.model._meta.get_field(self.parent_object_field_name).attname
+        return instance.__dict__.get(parent_attname)
+
+    def remember(self, instance, key, value):
+        """
+        Memoizes `value` under `key` along with the parent's id. Nothing is
+        memoized if `instance` doesn't inherit the value (its own value is cheap).
+        """
+        memo = instance.__dict__.setdefault(INHERITED_MEMO_ATTR, {})
         if self.inherit_only or getattr(instance, self.inherit_flag_name):
-            rel = getattr(instance, self.parent_object_field_name)
+            memo[key] = self.get_parent_id(instance), value
+        else:
+            memo.pop(key, None)
+
+    def recall(self, instance, key):
+        """
+        Returns the value memoized under `key` if `instance` still inherits it
+        from the same parent, `NOT_MEMOIZED` otherwise.
+        """
+        memo = instance.__dict__.get(INHERITED_MEMO_ATTR)
+        if memo and key in memo and (self.inherit_only or getattr(instance, self.inherit_flag_name)):
+            parent_id, value = memo[key]
+            if parent_id == self.get_parent_id(instance):
+                return value
+        return NOT_MEMOIZED
+
+    def get_value(self, instance):
+        "Computes the value (ignoring the values memoized by :func:`resolve_inherited`)."
+        if self.inherit_only or getattr(instance, self.inherit_flag_name):
+            stats = instrumentation.backend
+            if stats is not None and self.is_parent_unloaded(instance):
+                with instrumentation.timer(stats, self.stat_name + '.parent_load'):
+                    rel = getattr(instance, self.parent_object_field_name)
+            else:
+                rel = getattr(instance, self.parent_object_field_name)
             if rel:
                 return getattr(rel, self.inherited_field_name_in_parent or self.name)
         return getattr(instance, self.value_field_name, None)
 
+    def is_parent_unloaded(self, instance):
+        "Returns True if getting the parent of `instance` would query the database."
+        try:
+            parent_cache_name = self.parent_cache_name
+        except AttributeError:
+            parent_field = self.model._meta.get_field(self.parent_object_field_name)
+            parent_cache_name = self.parent_cache_name = parent_field.get_cache_name()
+            self.parent_attname = parent_field.attname
+        return (parent_cache_name not in instance.__dict__ and
+                instance.__dict__.get(self.parent_attname) is not None)
+
     def __set__(self, instance, value):
         if self.inherit_only:
             raise InheritedOnlyException(
                 "Can't set value for field %s on %s (field is inherit_only). Try to set it on %s.%s." %
                 (self.name, instance, self.parent_object_field_name, self.inherited_field_name_in_parent or self.name))
+        forget_inherited(instance, self.name)
         try:
             rel = getattr(instance, self.parent_object_field_name)
             if rel:
@@ -172,6 +349,46 @@ class InheritedField(Field):
             setattr(instance, self.inherit_flag_name, False)
         setattr(instance, self.value_field_name, value)
 
+def forget_inherited(instance, *field_names):
+    "Drops the values memoized for the inherited fields (all or `field_names`) of `instance`."
+    memo = instance.__dict__.get(INHERITED_MEMO_ATTR)
+    if not memo:
+        return
+    if not field_names:
+        memo.clear()
+    for name in field_names:
+        memo.pop(name, None)
+        memo.pop((name, 'display'), None)
+
+_pending_fields = defaultdict(list)
+
+def prepare_inherited_fields(sender, **kwargs):
+    """
+    Adds the value fields and patches the manager for the InheritedFields of
+    `sender`. This is the only `class_prepared` receiver, the fields register
+    themselves in `_pending_fields` (so defining a model costs a dict lookup
+    instead of a run through a receiver per InheritedField in the project).
+    """
+    fields = _pending_fields.pop(sender, None)
+    if not fields:
+        return
+    for field in fields:
+        if not field.inherit_only:
+            field.add_value_field(sender, name=field.name)
+    fields[0].patch_manager(sender)
+
+signals.class_prepared.connect(prepare_inherited_fields)
+
+def clone_field(field):
+    "Returns an unbound copy of `field` (only what `contribute_to_class` changes is copied)."
+    xfield = copy.copy(field)
+    if field.rel:
+        xfield.rel = copy.copy(field.rel)
+        if getattr(field.rel, 'field', None) is field:
+            xfield.rel.field = xfield
+    xfield.validators = list(field.validators)
+    return xfield
+
 def find_on_model(model, field_name, validate=True, callback=None, chain=None):
     target_fields = [
         target for target in model._meta.fields
@@ -239,63 +456,852 @@ def find_in_parent(model_class, relation_name, field_name, validate=True, callba
         raise TypeError("InheritedField: %s does not exist on %s." %
                         (relation_name, model_class))
 
+def inherited_index_sql(model, connection):
+    """
+    Returns the ``CREATE INDEX`` statements syncdb doesn't know about for the
+    InheritedFields of `model`: the partial indexes (``index='partial'``), the
+    ``index=True`` indexes on django < 1.5 (no ``Meta.index_together``) and
+    the indexes on the parent relations of the indexed fields if they have
+    ``db_index=False``.
+
+    The partial indexes are only made on PostgreSQL (it matches the
+    ``is_foo_inherited = false`` filters against ``WHERE NOT
+    is_foo_inherited``), a composite index is made elsewhere.
+    """
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    partial = connection.vendor == 'postgresql'
+    # flush sends post_syncdb again, IF NOT EXISTS keeps that working where we can
+    create = "CREATE INDEX IF NOT EXISTS" if connection.vendor in ('postgresql', 'sqlite') else "CREATE INDEX"
+    statements = []
+    for field in get_inherited_fields(model):
+        if not field.index or field.model is not model:
+            continue
+        fk = model._meta.get_field(field.parent_object_field_name)
+        if not fk.db_index:
+            statements.append("%s %s ON %s (%s)" % (
+                create, qn(truncate_name('%s_%s' % (table, fk.column), connection.ops.max_name_length())),
+                qn(table), qn(fk.column),
+            ))
+        value_column = model._meta.get_field(field.value_field_name).column
+        flag_column = model._meta.get_field(field.inherit_flag_name).column
+        if field.index is True:
+            if not hasattr(model._meta, 'index_together'):
+                columns = (value_column,) if field.materialize else (flag_column, value_column)
+                statements.append("%s %s ON %s (%s)" % (
+                    create, qn(truncate_name('%s_%s_inherited' % (table, value_column), connection.ops.max_name_length())),
+                    qn(table), ", ".join(qn(column) for column in columns),
+                ))
+            continue
+        name = qn(truncate_name('%s_%s_own' % (table, value_column), connection.ops.max_name_length()))
+        if partial:
+            statements.append("%s %s ON %s (%s) WHERE NOT %s" % (
+                create, name, qn(table), qn(value_column), qn(flag_column)))
+        else:
+            statements.append("%s %s ON %s (%s, %s)" % (
+                create, name, qn(table), qn(flag_column), qn(value_column)))
+    return statements
+
+def create_inherited_indexes(sender, created_models, db, **kwargs):
+    "Creates the indexes from :func:`inherited_index_sql` for the new models."
+    connection = connections[db]
+    for model in created_models:
+        if get_app(model._meta.app_label) is not sender:
+            continue # the signal is sent for each app with all the created models
+        cursor = connection.cursor()
+        for sql in inherited_index_sql(model, connection):
+            try:
+                cursor.execute(sql)
+            except DatabaseError, e: # already there (after a flush)
+                logger.debug("Not creating index: %s", e)
+
+signals.post_syncdb.connect(create_inherited_indexes)
+
+MATERIALIZED_FIELDS = []
+_materialized_children = {}
+
+def get_materialized_children(model):
+    """
+    Returns the InheritedFields that inherit from `model` and are materialized,
+    or aren't but have materialized fields inheriting from them (the changes go
+    through them).
+    """
+    try:
+        return _materialized_children[model]
+    except KeyError:
+        children = []
+        resolved = True
+        for field in MATERIALIZED_FIELDS:
+            parent = field.model._meta.get_field(field.parent_object_field_name).rel.to
+            if isinstance(parent, basestring):
+                resolved = False
+                continue
+            node = get_inheritance_node(field.model, field.name)
+            while node is not None and (node.field is field or not node.field.materialize):
+                if node.parent_model is model and node.field not in children:
+                    children.append(node.field)
+                node = node.parent_node
+        if resolved: # or else it can change when the lazy relation is resolved
+            _materialized_children[model] = children
+        return children
+
+def _source_names(field):
+    "The names of the parent fields that the value of `field` depends on."
+    node = get_inheritance_node(field.model, field.name)
+    if node.parent_node is not None:
+        parent_field = node.parent_node.field
+        return set([node.target_name, parent_field.inherit_flag_name, parent_field.value_field_name,
+                    parent_field.parent_object_field_name])
+    return set([node.target_name])
+
+def _affected_children(model, update_fields=None, journal=None, seen=frozenset()):
+    children = []
+    for field in get_materialized_children(model):
+        if update_fields is not None and not _source_names(field) & set(update_fields):
+            continue
+        if field.materialize:
+            if journal is None or field.journal == journal:
+                children.append(field)
+        elif journal is None or field not in seen and _affected_children(
+                field.model, [field.name], journal, seen | set([field])):
+            children.append(field)
+    return children
+
+def _propagate(model, pk_sql, params, update_fields, connection, journal=None):
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    parent_alias = qn("materialize_parent")
+    for field in _affected_children(model, update_fields, journal):
+        child = field.model
+        child_table = qn(child._meta.db_table)
+        fk = child._meta.get_field(field.parent_object_field_name)
+        if not field.materialize:
+            # the values change through these rows, update the ones inheriting from them
+            child_sql = "SELECT %s FROM %s WHERE %s IN (%s)" % (
+                qn(child._meta.pk.column), child_table, qn(fk.column), pk_sql)
+            if not field.inherit_only:
+                child_sql += " AND %s" % qn(child._meta.get_field(field.inherit_flag_name).column)
+            cursor.execute(child_sql, params)
+            if cursor.fetchone() is not None: # or else a relation to self would go on forever
+                _propagate(child, child_sql, params, set([field.name]), connection, journal)
+            continue
+        flag_column = qn(child._meta.get_field(field.inherit_flag_name).column)
+        cursor.execute("UPDATE %s SET %s = (SELECT %s FROM %s %s WHERE %s.%s = %s.%s) WHERE %s IN (%s) AND %s" % (
+            child_table,
+            qn(child._meta.get_field(field.value_field_name).column),
+            inherited_value_sql(model, field.inherited_field_name_in_parent or field.name, connection, parent_alias),
+            qn(model._meta.db_table), parent_alias,
+            parent_alias, qn(fk.rel.get_related_field().column), child_table, qn(fk.column),
+            qn(fk.column), pk_sql,
+            flag_column,
+        ), params)
+        _propagate(child, "SELECT %s FROM %s WHERE %s IN (%s) AND %s" % (
+            qn(child._meta.pk.column), child_table, qn(fk.column), pk_sql, flag_column,
+        ), params, set([field.name, field.value_field_name]), connection)
+
+def propagate_inherited(model, pks, using=None, update_fields=None, journal=None):
+    """
+    Updates the materialized inherited fields of all the rows that inherit
+    (directly or through other inherited fields) from the `model` rows with
+    the given `pks`. Runs one ``UPDATE ... WHERE parent_id IN (...) AND
+    is_X_inherited`` per field per level (and a ``SELECT`` per level of fields
+    that aren't materialized), nothing is loaded in Python.
+
+    This is done automatically when a parent is saved, call it after changing
+    parents with `QuerySet.update` or raw sql. If `update_fields` is given
+    only the fields depending on those are updated. If `journal` is given only
+    the fields with that `journal` setting are updated on the first level (the
+    deeper levels always follow).
+    """
+    pks = list(pks)
+    if not pks:
+        return
+    from django.db import router
+    using = using or router.db_for_write(model)
+    with atomic(using=using):
+        _propagate(model, ", ".join(["%s"] * len(pks)), pks,
+                   None if update_fields is None else set(update_fields), connections[using], journal)
+
+def _model_label(model):
+    return "%s.%s" % (model._meta.app_label, model._meta.object_name)
+
+def record_change(model, pk, using=None, update_fields=None):
+    "Records in the journal that the `model` row with `pk` has changed."
+    record_changes(model, [pk], using, update_fields)
+
+def record_changes(model, pks, using=None, update_fields=None):
+    "Records in the journal that the `model` rows with `pks` have changed (with one query)."
+    from customfields.models import InheritanceJournal
+    label = _model_label(model)
+    update_fields = ",".join(sorted(update_fields)) if update_fields is not None else ""
+    InheritanceJournal.objects.using(using).bulk_create([
+        InheritanceJournal(model=label, object_pk=unicode(pk), update_fields=update_fields)
+        for pk in pks
+    ])
+
+def propagate_changes(model, pks, using=None, update_fields=None):
+    """
+    Updates (or records in the journal, for the fields with `journal=True`) the
+    materialized fields inheriting from the `model` rows with `pks`.
+    """
+    if _affected_children(model, update_fields, journal=False):
+        propagate_inherited(model, pks, using, update_fields, journal=False)
+    if _affected_children(model, update_fields, journal=True):
+        record_changes(model, pks, using, update_fields)
+
+def _depth(model):
+    "How many materialized levels are above `model`."
+    return max([0] + [
+        _depth(field.model._meta.get_field(field.parent_object_field_name).rel.to) + 1
+        for field in MATERIALIZED_FIELDS if field.model is model
+    ])
+
+def coalesce_journal(entries):
+    """
+    Merges the journal `entries` into one ``(model, pks, update_fields)`` per
+    model (each pk once, `update_fields` is None if any entry changed all the
+    fields), parents before children. The entries of the models that aren't
+    installed anymore are skipped.
+    """
+    changes = SortedDict()
+    for entry in entries:
+        pks, update_fields = changes.setdefault(entry.model, (SortedDict(), set()))
+        pks[entry.object_pk] = None
+        if update_fields is not None:
+            if entry.update_fields:
+                update_fields.update(entry.update_fields.split(","))
+            else:
+                changes[entry.model] = pks, None
+    result = []
+    for label, (pks, update_fields) in changes.items():
+        model = get_model(*label.split("."))
+        if model is None:
+            logger.warning("Skipping the journal entries of %s (not an installed model).", label)
+            continue
+        model = _concrete_model(model)
+        result.append((model, [model._meta.pk.to_python(pk) for pk in pks], update_fields))
+    result.sort(key=lambda change: _depth(change[0]))
+    return result
+
+def _propagate_worker(args):
+    app_label, object_name, pks, using, update_fields = args
+    propagate_inherited(get_model(app_label, object_name), pks, using, update_fields, journal=True)
+
+def drain_journal(batch_size=1000, workers=1, using=None, callback=None):
+    """
+    Applies the changes recorded in the journal to the materialized fields
+    with `journal=True`, `batch_size` entries at a time. The entries of a
+    batch are coalesced (a parent that changed many times is propagated once)
+    and applied parents first, level by level, one set-based ``UPDATE`` per
+    field per level. With `workers > 1` the pks of each model are split among
+    that many processes. The entries are deleted once applied.
+
+    After each batch `callback` (if given) is called with the number of
+    entries applied. Returns the total number of entries applied.
+    """
+    from customfields.models import InheritanceJournal
+    from django.db import router
+    using = using or router.db_for_write(InheritanceJournal)
+    journal = InheritanceJournal.objects.using(using).order_by('pk')
+    pool = None
+    if workers > 1:
+        import multiprocessing
+        _close_connections() # the worker processes must not share our connections
+        pool = multiprocessing.Pool(workers, initializer=_close_connections)
+    total = 0
+    try:
+        while True:
+            entries = list(journal[:batch_size])
+            if not entries:
+                break
+            for model, pks, update_fields in coalesce_journal(entries):
+                if pool is None:
+                    propagate_inherited(model, pks, using, update_fields, journal=True)
+                else:
+                    pool.map(_propagate_worker, [
+                        (model._meta.app_label, model._meta.object_name, pks[i::workers], using, update_fields)
+                        for i in range(min(workers, len(pks)))
+                    ])
+            journal.filter(pk__in=[entry.pk for entry in entries]).delete()
+            total += len(entries)
+            logger.debug("Applied %s journal entries.", len(entries))
+            if callback:
+                callback(len(entries))
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+    return total
+
+def _concrete_model(model):
+    return getattr(model._meta, 'concrete_model', None) or model
+
+def materialize_on_save(sender, instance, raw=False, **kwargs):
+    "Stores the inherited values of the materialized fields before saving."
+    if raw:
+        return
+    for field in MATERIALIZED_FIELDS:
+        if field.model is _concrete_model(sender) and getattr(instance, field.inherit_flag_name):
+            try:
+                setattr(instance, field.value_field_name, field.get_value(instance))
+            except ObjectDoesNotExist:
+                pass
+
+def propagate_on_save(sender, instance, created, raw=False, using=None, update_fields=None, **kwargs):
+    "Updates the materialized fields inheriting from the saved instance."
+    if raw or created:
+        return
+    propagate_changes(_concrete_model(sender), [instance.pk], using, update_fields)
+
+signals.pre_save.connect(materialize_on_save)
+signals.post_save.connect(propagate_on_save)
+
+def get_inherited_fields(model, field_names=None):
+    "Returns the InheritedFields of `model` (all of them or the ones in `field_names`)."
+    fields = dict(
+        (field.name, field) for field in model._meta.virtual_fields
+            if isinstance(field, InheritedField)
+    )
+    if field_names is None:
+        return fields.values()
+    for name in field_names:
+        if name not in fields:
+            raise TypeError("InheritedField: %s does not exist in %s." % (name, model))
+    return [fields[name] for name in field_names]
+
+class InheritanceNode(object):
+    """
+    How an InheritedField (`field`) of `model` gets its value, resolved once:
+
+        - `parent_field`: the relation to the parent, `parent_model` its target
+          (None if it isn't a relation, for fields with `validate=False`)
+        - `target_name`: the name of the field in the parent and `parent_node`
+          its node if it's inherited there too
+        - `path`: the relation names up to the model that has the value
+        - `terminal_model`, `terminal_field`: that model and the concrete field
+          (None if it isn't a concrete field, eg: a ManyToManyField)
+    """
+    def __init__(self, model, field):
+        self.model = model
+        self.field = field
+        self.target_name = field.inherited_field_name_in_parent or field.name
+        self.parent_field = self.parent_model = self.parent_node = None
+        self.path = (field.parent_object_field_name,)
+        self.terminal_model = self.terminal_field = None
+
+    def __repr__(self):
+        return "<InheritanceNode %s.%s: %s>" % (self.model.__name__, self.field.name, LOOKUP_SEP.join(self.path))
+
+_inheritance_graphs = {}
+
+def _compile_node(model, field, seen):
+    node = InheritanceNode(model, field)
+    try:
+        fk = model._meta.get_field(field.parent_object_field_name)
+    except FieldDoesNotExist:
+        return node, True
+    if not isinstance(fk, RelatedField):
+        return node, True
+    if isinstance(fk.rel.to, basestring):
+        return node, False # not resolved yet
+    node.parent_field = fk
+    node.parent_model = node.terminal_model = parent_model = fk.rel.to
+    if (parent_model, node.target_name) in seen:
+        return node, True # a cycle, don't follow it
+    parent_fields = dict((f.name, f) for f in get_inherited_fields(parent_model))
+    if node.target_name in parent_fields:
+        if parent_model in _inheritance_graphs:
+            parent_node, resolved = _inheritance_graphs[parent_model][node.target_name], True
+        else:
+            parent_node, resolved = _compile_node(parent_model, parent_fields[node.target_name],
+                                                  seen | set([(model, field.name)]))
+        node.parent_node = parent_node
+        node.path += parent_node.path
+        node.terminal_model, node.terminal_field = parent_node.terminal_model, parent_node.terminal_field
+        return node, resolved
+    try:
+        node.terminal_field = parent_model._meta.get_field(node.target_name, many_to_many=False)
+    except FieldDoesNotExist:
+        pass
+    return node, True
+
+def get_inheritance_graph(model):
+    """
+    Returns the compiled inheritance graph of `model`: a dict of
+    :class:`InheritanceNode` by InheritedField name. It's compiled on the first
+    use (when the models are ready) and kept for the following calls.
+    """
+    try:
+        return _inheritance_graphs[model]
+    except KeyError:
+        graph = {}
+        complete = True
+        for field in get_inherited_fields(model):
+            graph[field.name], resolved = _compile_node(model, field, set())
+            complete = complete and resolved
+        if complete: # or else it can change when the lazy relations are resolved
+            _inheritance_graphs[model] = graph
+        return graph
+
+def get_inheritance_node(model, field_name):
+    "Returns the :class:`InheritanceNode` of the InheritedField `field_name` of `model`."
+    try:
+        return get_inheritance_graph(model)[field_name]
+    except KeyError:
+        raise TypeError("InheritedField: %s does not exist in %s." % (field_name, model))
+
+def get_inheritance_paths(model, field_names=None):
+    "Returns the `select_related` paths to the parents of the inherited fields (all or `field_names`)."
+    related = set()
+    graph = get_inheritance_graph(model)
+    for name in field_names or graph:
+        node = get_inheritance_node(model, name)
+        if not node.field.materialize:
+            related.add(LOOKUP_SEP.join(node.path))
+    return related
+
+def _inheritance_columns(node, prefix, columns):
+    field = node.field
+    if not field.inherit_only:
+        columns.add(prefix + field.inherit_flag_name)
+        columns.add(prefix + field.value_field_name)
+    if field.materialize:
+        return
+    columns.add(prefix + field.parent_object_field_name)
+    prefix += field.parent_object_field_name + LOOKUP_SEP
+    if node.parent_node is not None:
+        _inheritance_columns(node.parent_node, prefix, columns)
+    elif node.terminal_field is not None:
+        columns.add(prefix + node.target_name)
+    # else eg: a ManyToManyField, the parent's pk is enough
+
+def get_inheritance_columns(model, field_names=None):
+    """
+    Returns the column names (for `only`) needed to compute the inherited fields
+    (all or `field_names`): all the columns of `model` and only the needed
+    columns of the parents.
+    """
+    columns = set(field.name for field in model._meta.fields)
+    for field in get_inherited_fields(model, field_names):
+        _inheritance_columns(get_inheritance_node(model, field.name), '', columns)
+    return columns
+
+def _load_parents(model, instances, fields, using, materialized=False):
+    """
+    Loads the parents of `instances` needed by `fields`, with one query per
+    relation, then does the same for the parents (if the fields are inherited
+    there too). The materialized fields don't need the parents unless
+    `materialized` is true.
+    """
+    by_relation = defaultdict(list)
+    for field in fields:
+        if materialized or not field.materialize:
+            by_relation[field.parent_object_field_name].append(field)
+
+    for relation_name, relation_fields in by_relation.iteritems():
+        try:
+            fk = model._meta.get_field(relation_name)
+        except FieldDoesNotExist:
+            continue
+        if not isinstance(fk, RelatedField) or isinstance(fk, ManyToManyField):
+            continue
+        cache_name = fk.get_cache_name()
+        related_field = fk.rel.get_related_field()
+
+        parents = {}
+        pending = defaultdict(list)
+        for obj in instances:
+            if not any(field.inherit_only or getattr(obj, field.inherit_flag_name) for field in relation_fields):
+                continue
+            if hasattr(obj, cache_name):
+                parent = getattr(obj, cache_name)
+                if parent is not None:
+                    parents[id(parent)] = parent
+            else:
+                value = getattr(obj, fk.attname)
+                if value is not None:
+                    pending[value].append(obj)
+        if pending:
+            for parent in fk.rel.to._base_manager.using(using).filter(**{
+                '%s__in' % related_field.name: list(pending)
+            }):
+                parents[id(parent)] = parent
+                for obj in pending[getattr(parent, related_field.attname)]:
+                    setattr(obj, cache_name, parent)
+
+        parent_fields = set()
+        for field in relation_fields:
+            parent_node = get_inheritance_node(model, field.name).parent_node
+            if parent_node is not None:
+                parent_fields.add(parent_node.field)
+        if parents and parent_fields:
+            _load_parents(fk.rel.to, parents.values(), parent_fields, using, materialized)
+
+def resolve_inherited(instances, field_names=None, using=None, display=False):
+    """
+    Computes the values of the inherited fields (all of them or the ones in
+    `field_names`) for `instances` (all of the same model) and memoizes them on
+    the instances. With `display=True` the ``get_{fieldname}_display()``
+    values are computed and memoized too (eg: for a page of the admin
+    changelist).
+
+    The parents are loaded level by level, one query per relation per level
+    (instead of one query per instance per level). Only the parents of the
+    instances that actually inherit the value are loaded.
+
+    A memoized value is used while the instance inherits it from the same
+    parent: setting the field, the inheritance flag or the parent drops it.
+    Changes to the parents themselves after this are not seen, call this again
+    if needed.
+    """
+    instances = list(instances)
+    if not instances:
+        return
+    model = instances[0].__class__
+    fields = get_inherited_fields(model, field_names)
+    _load_parents(model, instances, fields, using or instances[0]._state.db, display)
+    for obj in instances:
+        for field in fields:
+            if not (field.materialize and not obj._state.adding): # those are read from the row
+                field.remember(obj, field.name, field.get_value(obj))
+            if display:
+                field.remember(obj, (field.name, 'display'), field.compute_field_display(obj))
+
+def inherited_value_sql(model, field_name, connection, alias=None, depth=0):
+    """
+    Returns the SQL expression that computes the value of `field_name` for a
+    row of `model` (`alias` is the row's table alias, the table name if not
+    given)::
+
+        CASE WHEN is_foo_inherited THEN (SELECT <parent value> ...) ELSE foo_value END
+
+    The parent value is computed the same way if it's inherited too (with a
+    nested subquery for each level).
+    """
+    qn = connection.ops.quote_name
+    alias = alias or qn(model._meta.db_table)
+    node = get_inheritance_graph(model).get(field_name)
+    if node is None:
+        try:
+            column = model._meta.get_field(field_name, many_to_many=False).column
+        except FieldDoesNotExist:
+            raise TypeError("InheritedField: %s is not a concrete field of %s." % (field_name, model))
+        return "%s.%s" % (alias, qn(column))
+
+    field = node.field
+    if field.materialize:
+        return "%s.%s" % (alias, qn(model._meta.get_field(field.value_field_name).column))
+    fk = node.parent_field
+    parent_model = node.parent_model
+    parent_alias = qn("inherited_%s" % depth)
+    parent_value = "(SELECT %s FROM %s %s WHERE %s.%s = %s.%s)" % (
+        inherited_value_sql(parent_model, node.target_name, connection, parent_alias, depth + 1),
+        qn(parent_model._meta.db_table), parent_alias,
+        parent_alias, qn(fk.rel.get_related_field().column),
+        alias, qn(fk.column),
+    )
+    if field.inherit_only:
+        return parent_value
+    return "CASE WHEN %s.%s THEN %s ELSE %s.%s END" % (
+        alias, qn(model._meta.get_field(field.inherit_flag_name).column),
+        parent_value,
+        alias, qn(model._meta.get_field(field.value_field_name).column),
+    )
+
+_lookup_branches = {}
+
+def _node_branches(node, prefix, tail):
+    field = node.field
+    if field.materialize:
+        return [((), prefix + [field.value_field_name] + tail)]
+    branches = []
+    conditions = ()
+    if not field.inherit_only:
+        flag = LOOKUP_SEP.join(prefix + [field.inherit_flag_name])
+        branches.append((((flag, False),), prefix + [field.value_field_name] + tail))
+        conditions = ((flag, True),)
+    prefix = prefix + [field.parent_object_field_name]
+    if node.parent_node is None:
+        branches.append((conditions, prefix + [node.target_name] + tail))
+    else:
+        for parent_conditions, parts in _node_branches(node.parent_node, prefix, tail):
+            branches.append((conditions + parent_conditions, parts))
+    return branches
+
+def get_lookup_branches(model, lookup):
+    """
+    Returns how to rewrite the `lookup` (eg: ``parent__foo__startswith``) of a
+    `model` filter if it goes through an InheritedField (None if it doesn't): a
+    list of ``(conditions, lookup)`` branches to OR, one per level where the
+    value can be::
+
+        [(((is_foo_inherited, False),), 'foo_value__startswith'),
+         (((is_foo_inherited, True),), 'parent__foo__startswith')]
+
+    The lookups hit the `{fieldname}_value` columns and the parent relations
+    directly (and only the `_value` column for materialized fields) so they can
+    use the indexes on those. Computed once per model and lookup.
+    """
+    key = (model, lookup)
+    try:
+        return _lookup_branches[key]
+    except KeyError:
+        pass
+    parts = lookup.split(LOOKUP_SEP)
+    branches = None
+    for i, part in enumerate(parts):
+        node = get_inheritance_graph(model).get(part)
+        if node is not None:
+            branches = [
+                (conditions, LOOKUP_SEP.join(branch_parts))
+                for conditions, branch_parts in _node_branches(node, parts[:i], parts[i + 1:])
+            ]
+            break
+        try:
+            field, _, direct, _ = model._meta.get_field_by_name(part)
+        except FieldDoesNotExist:
+            break
+        if not direct:
+            model = field.model # a reverse relation
+        elif field.rel:
+            model = field.rel.to
+        else:
+            break
+    _lookup_branches[key] = branches
+    return branches
+
+def rewrite_q(model, q):
+    """
+    Returns `q` (a :class:`Q` tree) with the lookups on InheritedFields of
+    `model` replaced by the ORed branches from :func:`get_lookup_branches`
+    (`q` itself if there are none).
+    """
+    children = []
+    changed = False
+    for child in q.children:
+        if isinstance(child, Node):
+            new_child = rewrite_q(model, child)
+        else:
+            lookup, value = child
+            branches = get_lookup_branches(model, lookup)
+            if branches is None:
+                new_child = child
+            else:
+                new_child = reduce(operator.or_, [
+                    Q(**dict(conditions, **{branch_lookup: value}))
+                    for conditions, branch_lookup in branches
+                ])
+        changed = changed or new_child is not child
+        children.append(new_child)
+    if not changed:
+        return q
+    q = copy.copy(q)
+    q.children = children
+    return q
+
 class InheritedFieldQuerySet(QuerySet):
+    _resolve_inherited = None
+    _resolve_display = False
+    _inherited_annotations = ()
+
+    def select_inherited(self, *field_names, **kwargs):
+        """
+        Joins (`select_related`) the parents needed by the given inherited
+        fields (all of them if none given). Unless `narrow=False` is given only
+        the parent columns needed for the inherited values are loaded (note
+        that this uses `only()` so don't combine it with other `only()` calls).
+        """
+        qs = self.select_related(*get_inheritance_paths(self.model, field_names or None))
+        if kwargs.get('narrow', True):
+            qs = qs.only(*get_inheritance_columns(self.model, field_names or None))
+        return qs
+
+    def with_inherited(self, *field_names):
+        """
+        Computes the values of the given inherited fields (all of them if none
+        given) in the database (see :func:`inherited_value_sql`) and adds them
+        as ``{fieldname}_effective`` (see `EFFECTIVE_VALUE_NAME`) to the rows.
+
+        That can be used in `order_by`, `values`, `values_list` etc. On the
+        returned objects the inherited fields won't touch the parents.
+        """
+        connection = connections[self.db]
+        select = SortedDict()
+        names = []
+        for field in get_inherited_fields(self.model, field_names or None):
+            select[EFFECTIVE_VALUE_NAME % field.name] = inherited_value_sql(self.model, field.name, connection)
+            names.append(field.name)
+        return self.extra(select=select)._clone(_inherited_annotations=self._inherited_annotations + tuple(names))
+
+    def resolve_inherited(self, *field_names, **kwargs):
+        """
+        Resolves the inherited values (all of them if no `field_names` are
+        given, and their display with `display=True`) while iterating, for
+        every `RESOLVE_BATCH_SIZE` objects. See :func:`resolve_inherited`.
+        """
+        return self._clone(_resolve_inherited=field_names, _resolve_display=kwargs.get('display', False))
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('_resolve_inherited', self._resolve_inherited)
+        kwargs.setdefault('_resolve_display', self._resolve_display)
+        kwargs.setdefault('_inherited_annotations', self._inherited_annotations)
+        return super(InheritedFieldQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def iterator(self):
+        objs = super(InheritedFieldQuerySet, self).iterator()
+        if self._inherited_annotations:
+            objs = self._memoize_annotations(objs)
+        if self._resolve_inherited is not None:
+            objs = self._resolve_batches(objs)
+        return objs
+
+    def _memoize_annotations(self, objs):
+        # the extra columns come back as the database returns them (eg: strings
+        # for dates on SQLite), they're converted like the terminal field's
+        connection = connections[self.db]
+        graph = get_inheritance_graph(self.model)
+        fields = [(graph[name].field, EFFECTIVE_VALUE_NAME % name, graph[name].terminal_field)
+                  for name in self._inherited_annotations]
+        for obj in objs:
+            for field, attr, terminal_field in fields:
+                value = getattr(obj, attr)
+                if terminal_field is not None and value is not None:
+                    value = terminal_field.to_python(connection.ops.convert_values(value, terminal_field))
+                    setattr(obj, attr, value)
+                field.remember(obj, field.name, value)
+            yield obj
+
+    def _resolve_batches(self, objs):
+        field_names = self._resolve_inherited or None
+        while True:
+            batch = list(islice(objs, RESOLVE_BATCH_SIZE))
+            if not batch:
+                return
+            resolve_inherited(batch, field_names, self.db, self._resolve_display)
+            for obj in batch:
+                yield obj
+
+    def _parent_value_sql(self, node, connection):
+        "The subquery that gives the parent's value of `node`'s field for a row of the updated table."
+        qn = connection.ops.quote_name
+        alias = qn("set_parent")
+        return "(SELECT %s FROM %s %s WHERE %s.%s = %s.%s)" % (
+            inherited_value_sql(node.parent_model, node.target_name, connection, alias),
+            qn(node.parent_model._meta.db_table), alias,
+            alias, qn(node.parent_field.rel.get_related_field().column),
+            qn(self.model._meta.db_table), qn(node.parent_field.column),
+        )
+
+    def _update_inherited(self, names, assignments, params):
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        model = self.model
+        needs_pks = bool(_affected_children(model, names)) # the filters may not match after the update
+        if needs_pks or not connection.features.update_can_self_select:
+            pks = list(self.values_list('pk', flat=True))
+            if not pks:
+                return 0
+            pk_sql, pk_params = ", ".join(["%s"] * len(pks)), pks
+        else:
+            pk_sql, pk_params = self.values('pk').query.get_compiler(self.db).as_sql()
+        with atomic(using=self.db):
+            cursor = connection.cursor()
+            cursor.execute("UPDATE %s SET %s WHERE %s IN (%s)" % (
+                qn(model._meta.db_table), ", ".join(assignments), qn(model._meta.pk.column), pk_sql,
+            ), params + list(pk_params))
+            if needs_pks:
+                propagate_changes(model, pks, self.db, names)
+        return cursor.rowcount
+
+    def set_inherited(self, **values):
+        """
+        Sets the given inherited fields on all the rows with one ``UPDATE``:
+        ``{fieldname}_value`` gets the value and ``is_{fieldname}_inherited``
+        is computed in SQL from the parent's value (true if equal, like
+        setting the field on an instance does). The materialized fields
+        inheriting from the rows are updated too. Returns the number of rows.
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        assignments, params = [], []
+        for name, value in sorted(values.items()):
+            node = get_inheritance_node(self.model, name)
+            field = node.field
+            if field.inherit_only:
+                raise InheritedOnlyException("Can't set value for field %s (field is inherit_only)." % name)
+            value_field = self.model._meta.get_field(field.value_field_name)
+            if isinstance(value, Model) and value_field.rel: # an inherited ForeignKey
+                value = getattr(value, value_field.rel.get_related_field().attname)
+            db_value = value_field.get_db_prep_save(value, connection)
+            assignments.append("%s = %%s" % qn(value_field.column))
+            params.append(db_value)
+            if value is None:
+                assignments.append("%s = CASE WHEN %s.%s IS NOT NULL AND %s IS NULL THEN %%s ELSE %%s END" % (
+                    qn(self.model._meta.get_field(field.inherit_flag_name).column),
+                    qn(self.model._meta.db_table), qn(node.parent_field.column),
+                    self._parent_value_sql(node, connection)))
+                params.extend([True, False])
+            else:
+                assignments.append("%s = CASE WHEN %s = %%s THEN %%s ELSE %%s END" % (
+                    qn(self.model._meta.get_field(field.inherit_flag_name).column),
+                    self._parent_value_sql(node, connection)))
+                params.extend([db_value, True, False])
+        return self._update_inherited(set(values), assignments, params)
+
+    def reset_inherited(self, *field_names):
+        """
+        Makes all the rows inherit the given fields again, with one ``UPDATE``
+        (the materialized fields get the parent's value). Returns the number
+        of rows.
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        assignments, params = [], []
+        for name in field_names:
+            node = get_inheritance_node(self.model, name)
+            field = node.field
+            if field.inherit_only:
+                continue
+            assignments.append("%s = %%s" % qn(self.model._meta.get_field(field.inherit_flag_name).column))
+            params.append(True)
+            if field.materialize:
+                assignments.append("%s = %s" % (
+                    qn(self.model._meta.get_field(field.value_field_name).column),
+                    self._parent_value_sql(node, connection)))
+        if not assignments:
+            return 0
+        return self._update_inherited(set(field_names), assignments, params)
+
     def is_inherited(self, parts):
-        _parts = parts[:]
-        last_field_name, model = self.traverse_models(_parts, self.model)
-        return hasattr(model, 'FIELD_INHERITANCE_MAP') and \
-               last_field_name in model.FIELD_INHERITANCE_MAP
-
-    def traverse_models(self, parts, model):
-        next_part = parts.pop(0)
-        if(parts):
-            next_model = self.model._meta.get_field(next_part).rel.to
-            return self.traverse_models(parts, next_model)
-        return (next_part, model)
-
-    def split_field(self, field):
-        parts = field.split(LOOKUP_SEP)
-        lookup = None
-        if parts[-1] in QUERY_TERMS:
-            lookup = parts.pop(-1)
-        return (parts,lookup)
-
-    def patch_child(self, parts, lookup, value):
-        inherited_flag = ["is_%s_inherited" % parts[-1]]
-        inherited_value = ["%s_value" % parts[-1]]
-        lookup = [lookup] if lookup else []
-        is_inherited = LOOKUP_SEP.join(parts[:-1] + inherited_flag)
-        field = LOOKUP_SEP.join(parts[:-1] + inherited_value + lookup)
-        print is_inherited
-        print field
-        return Q(**{is_inherited: False, field: value})
-
-    def patch_parent(self, parts, lookup, value):
-        _parts = parts[:]
-        last_field_name, model = self.traverse_models(_parts, self.model)
-        lookup = [lookup] if lookup else []
-        parents_name, parents_field_name = model.FIELD_INHERITANCE_MAP[last_field_name]
-        parent_lookup = LOOKUP_SEP.join(parts[:-1] + [parents_name] + [parents_field_name] + lookup)
-        print parent_lookup
-        return Q(**{parent_lookup: value})
-
-    def patch(self, parts, lookup, value):
-        child = self.patch_child(parts, lookup, value)
-        parent = self.patch_parent(parts, lookup, value)
-        return child | parent
-
-    def filter(self, *args, **kwargs):
-        # We don't support Q objects, bail out if any
-        assert not args
-        args = []
-        old_kwargs = kwargs.copy()
-        for field, value in kwargs.items():
-            parts, lookup = self.split_field(field)
-            if self.is_inherited(parts):
-                old_kwargs.pop(field)
-                args.append(self.patch(parts, lookup, value))
-        return super(InheritedFieldQuerySet, self).filter(*args, **old_kwargs)
+        "Tells if the `parts` lookup goes through an InheritedField."
+        return get_lookup_branches(self.model, LOOKUP_SEP.join(parts)) is not None
+
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        if kwargs:
+            args += (Q(**kwargs),)
+        args = [rewrite_q(self.model, q) for q in args]
+        return super(InheritedFieldQuerySet, self)._filter_or_exclude(negate, *args)
 
 class InheritedFieldManager(Manager):
     def get_query_set(self):
         return InheritedFieldQuerySet(self.model, using=self._db)
+
+    def resolve_inherited(self, *field_names, **kwargs):
+        return self.get_query_set().resolve_inherited(*field_names, **kwargs)
+
+    def select_inherited(self, *field_names, **kwargs):
+        return self.get_query_set().select_inherited(*field_names, **kwargs)
+
+    def with_inherited(self, *field_names):
+        return self.get_query_set().with_inherited(*field_names)
+
+    def set_inherited(self, **values):
+        return self.get_query_set().set_inherited(**values)
+
+    def reset_inherited(self, *field_names):
+        return self.get_query_set().reset_inherited(*field_names)
@@ -0,0 +1,98 @@
+"""
+Optional counters and timings for the custom fields. Nothing is recorded (and
+the fields only pay for a global lookup) until a stats backend is installed::
+
+    import statsd
+    from customfields import instrumentation
+    instrumentation.set_backend(statsd.StatsClient(prefix='myproject'))
+
+A backend is anything with the statsd client's ``incr(stat, count=1,
+rate=1)`` and ``timing(stat, delta, rate=1)`` methods (timings are in
+milliseconds). :class:`LocalStats` keeps them in memory, handy in tests or
+to look at a single request::
+
+    with instrumentation.recording() as stats:
+        ...
+    print stats.counters
+
+The stats are named ``customfields.<kind>.<app_label>.<Model>.<field>.<event>``:
+
+    - ``inherited.*.hit``: InheritedField reads.
+    - ``inherited.*.parent_load``: parent objects loaded (a query) by a read,
+      count and timing.
+    - ``setfield.*.encode``, ``setfield.*.decode``: SetField values written
+      and read, count and timing, with the byte sizes counted in
+      ``encode.bytes`` and ``decode.bytes``.
+    - ``cachedm2m.*.add``, ``cachedm2m.*.remove``: ids added and removed from
+      a CachedManyToManyField cache by its manager, ``cachedm2m.*.clear`` and
+      ``cachedm2m.*.sync`` (caches recomputed for `sync_cache=True`).
+"""
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+STAT_PREFIX = 'customfields'
+
+backend = None
+
+__all__ = ('STAT_PREFIX', 'LocalStats', 'set_backend', 'get_backend', 'recording', 'stat_name', 'timer')
+
+class LocalStats(object):
+    "A statsd compatible backend that keeps the counters and timings in memory."
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(list)
+        self.gauges = {}
+
+    def incr(self, stat, count=1, rate=1):
+        self.counters[stat] += count
+
+    def decr(self, stat, count=1, rate=1):
+        self.counters[stat] -= count
+
+    def timing(self, stat, delta, rate=1):
+        self.timings[stat].append(delta)
+
+    def gauge(self, stat, value, rate=1, delta=False):
+        self.gauges[stat] = self.gauges.get(stat, 0) + value if delta else value
+
+    def total_time(self, stat):
+        "The sum of the timings (ms) recorded for `stat`."
+        return sum(self.timings.get(stat, ()))
+
+    def reset(self):
+        self.counters.clear()
+        self.timings.clear()
+        self.gauges.clear()
+
+def set_backend(stats):
+    "Installs `stats` as the backend (None disables the instrumentation). Returns the old one."
+    global backend
+    old, backend = backend, stats
+    return old
+
+def get_backend():
+    return backend
+
+@contextmanager
+def recording(stats=None):
+    "Installs `stats` (a new :class:`LocalStats` by default) for the duration of the block."
+    stats = LocalStats() if stats is None else stats
+    old = set_backend(stats)
+    try:
+        yield stats
+    finally:
+        set_backend(old)
+
+def stat_name(kind, model, field_name):
+    return '%s.%s.%s.%s.%s' % (STAT_PREFIX, kind, model._meta.app_label, model._meta.object_name, field_name)
+
+@contextmanager
+def timer(stats, stat):
+    "Counts `stat` and records the duration of the block."
+    start = time.time()
+    try:
+        yield
+    finally:
+        stats.timing(stat, (time.time() - start) * 1000)
+        stats.incr(stat)
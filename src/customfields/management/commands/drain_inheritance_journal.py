@@ -0,0 +1,32 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from customfields.inheritedfield import drain_journal
+
+class Command(BaseCommand):
+    help = "Propagates the parent changes recorded in the inheritance journal."
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=1000,
+            help='How many journal entries to apply at a time. Defaults to 1000.'),
+        make_option('--workers', type='int', default=1,
+            help='How many processes to use. Defaults to 1.'),
+        make_option('--database', default=DEFAULT_DB_ALIAS,
+            help='Nominates a database. Defaults to the "default" database.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        def progress(count):
+            if verbosity > 1:
+                self.stdout.write("Applied %s entries\n" % count)
+
+        total = drain_journal(
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+            using=options['database'],
+            callback=progress)
+        if verbosity:
+            self.stdout.write("Applied %s journal entries.\n" % total)
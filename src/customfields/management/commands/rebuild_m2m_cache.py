@@ -0,0 +1,48 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, DEFAULT_DB_ALIAS
+from django.db.models.fields import FieldDoesNotExist
+
+from customfields.cachedmtmfield import rebuild_cache
+
+class Command(BaseCommand):
+    args = '<app_label.ModelName> <field_name>'
+    help = "Recomputes the cache of a CachedManyToManyField from the through table."
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', default=1000,
+            help='How many rows to rebuild per query. Defaults to 1000.'),
+        make_option('--start-pk', default=None,
+            help='Resume from this primary key (inclusive).'),
+        make_option('--workers', type='int', default=1,
+            help='How many processes to use. Defaults to 1.'),
+        make_option('--database', default=DEFAULT_DB_ALIAS,
+            help='Nominates a database. Defaults to the "default" database.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2 or args[0].count('.') != 1:
+            raise CommandError("Usage: rebuild_m2m_cache %s" % self.args)
+        model = models.get_model(*args[0].split('.'))
+        if model is None:
+            raise CommandError("Unknown model: %s" % args[0])
+        start_pk = options['start_pk']
+        if start_pk is not None:
+            start_pk = model._meta.pk.to_python(start_pk)
+        verbosity = int(options.get('verbosity', 1))
+
+        def progress(pk):
+            if verbosity > 1:
+                self.stdout.write("Rebuilt up to pk %s\n" % pk)
+
+        try:
+            last_pk = rebuild_cache(model, args[1],
+                chunk_size=options['chunk_size'],
+                start_pk=start_pk,
+                workers=options['workers'],
+                using=options['database'],
+                callback=progress)
+        except (TypeError, FieldDoesNotExist), e:
+            raise CommandError(e)
+        if verbosity:
+            self.stdout.write("Rebuilt %s.%s cache (last pk: %s).\n" % (args[0], args[1], last_pk))
@@ -0,0 +1,19 @@
+from django.db import models
+
+class InheritanceJournal(models.Model):
+    """
+    A parent change that still has to be propagated to the materialized
+    ``InheritedField(journal=True)`` fields inheriting from it. Drained by
+    :func:`customfields.inheritedfield.drain_journal` (or the
+    ``drain_inheritance_journal`` command).
+    """
+    model = models.CharField(max_length=100) # app_label.ModelName
+    object_pk = models.CharField(max_length=255)
+    update_fields = models.TextField(blank=True) # comma separated, empty means all
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('id',)
+
+    def __unicode__(self):
+        return u"%s(pk=%s)" % (self.model, self.object_pk)
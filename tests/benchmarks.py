@@ -0,0 +1,236 @@
+"""
+Benchmarks for the custom fields. They run against a throwaway test database
+(SQLite with the test project settings). Usage::
+
+    PYTHONPATH=src:tests DJANGO_SETTINGS_MODULE=test_project.settings python tests/benchmarks.py \\
+        [--save results.json] [--compare tests/benchmarks-baseline.json] [name ...]
+
+Every case records the best wall time of a call (in microseconds) and the
+number of queries a call makes. ``--compare`` reports the cases that make
+more queries than the baseline (and exits with status 1) or got more than
+`SLOWER_RATIO` times slower. Refresh the baseline with ``--save
+tests/benchmarks-baseline.json`` when a change is expected to move the
+numbers (the times depend on the machine, the query counts don't).
+"""
+import sys
+import json
+import time
+import timeit
+from optparse import OptionParser
+
+BENCHMARKS = []
+RESULTS = []
+SLOWER_RATIO = 1.5
+ROW_COUNTS = (100, 1000)
+CACHE_SIZES = (0, 10, 100)
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+def per_call(func, number):
+    "Returns the best time (in microseconds) of a single `func()` call."
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1000000
+
+def count_queries(func):
+    "Returns how many queries a `func()` call makes."
+    from django.db import connection
+    from test_app.tests import CaptureQueriesContext # with a fallback for django < 1.6
+    with CaptureQueriesContext(connection) as queries:
+        func()
+    return len([q for q in queries.captured_queries if 'SAVEPOINT' not in q['sql']])
+
+def measure(benchmark, case, func, number=1):
+    "Times `func` and counts its queries, prints and records the result."
+    queries = count_queries(func)
+    usec = per_call(func, number)
+    RESULTS.append({'benchmark': benchmark, 'case': case, 'usec': round(usec, 2), 'queries': queries})
+    print "    %-40s %12.2f usec %6s queries" % (case, usec, queries)
+
+def reset(*models):
+    for model in models:
+        model._base_manager.all().delete()
+
+@benchmark
+def manager_access():
+    "Cost of `obj.m2mrel` access (should not grow with the number of accesses)."
+    from test_app.models import TestModel1_Cached
+    obj = TestModel1_Cached.objects.create()
+    classes = set()
+    def access():
+        classes.add(obj.m2mrel.__class__)
+    for number in (1000, 10000, 100000):
+        measure('manager_access', '%s accesses' % number, access, number)
+    print "    %6s manager classes created" % len(classes)
+
+@benchmark
+def descriptor_access():
+    "Cost of reading the cache through the manager and the cache field."
+    from test_app.models import TestModel1_Cached, Stuff
+    reset(TestModel1_Cached, Stuff)
+    for size in CACHE_SIZES:
+        obj = TestModel1_Cached.objects.create()
+        obj.m2mrel.add(*[Stuff.objects.create() for i in range(size)])
+        obj = TestModel1_Cached.objects.get(pk=obj.pk)
+        measure('descriptor_access', 'm2mrel.cache, %s ids' % size, lambda: obj.m2mrel.cache, 10000)
+        measure('descriptor_access', 'm2mrel_cache, %s ids' % size, lambda: obj.m2mrel_cache, 10000)
+
+@benchmark
+def setfield_codecs():
+    "SetField encode/decode per codec and set size."
+    from customfields.cachedmtmfield import get_codec
+    for name in ('pickle', 'csv', 'varint', 'json'):
+        codec = get_codec(name)
+        for size in (10, 100, 1000):
+            value = set(range(1, size * 7, 7))
+            encoded = codec.encode(value)
+            measure('setfield_codecs', '%s encode, %s ids (%s bytes)' % (name, size, len(encoded)),
+                    lambda: codec.encode(value), 100)
+            measure('setfield_codecs', '%s decode, %s ids' % (name, size), lambda: codec.decode(encoded), 100)
+
+@benchmark
+def queryset_iteration():
+    "Iterating a queryset with cached m2m fields, by row count and cache size."
+    from test_app.models import TestModel1_Cached, TestModelE
+    for model in (TestModel1_Cached, TestModelE):
+        field = 'm2mrel_cache' if model is TestModel1_Cached else 'cmtm_a_cache'
+        for rows in ROW_COUNTS:
+            reset(model)
+            model.objects.bulk_create([model() for i in range(rows)])
+            for size in CACHE_SIZES:
+                model.objects.update(**{field: set(range(1, size + 1))})
+                measure('queryset_iteration', '%s, %s rows, %s ids' % (model.__name__, rows, size),
+                        lambda: [getattr(obj, field) for obj in model.objects.all()], 3)
+
+@benchmark
+def m2m_add_remove():
+    "Adding then removing related objects through the caching manager."
+    from test_app.models import TestModelC, TestModelA
+    reset(TestModelC, TestModelA)
+    obj = TestModelC.objects.create()
+    for size in (1, 10, 100):
+        targets = [TestModelA.objects.create() for i in range(size)]
+        def cycle():
+            obj.cmtm_a.add(*targets)
+            obj.cmtm_a.remove(*targets)
+        measure('m2m_add_remove', 'add+remove %s objects' % size, cycle, 10)
+
+def make_chains(rows):
+    "Makes `rows` TestModel1 -> TestModelQ6 -> TestModelQ7 -> TestModelQ8 chains, every 4th overrides foo."
+    from test_app.models import TestModel1, TestModelQ6, TestModelQ7, TestModelQ8
+    reset(TestModelQ8, TestModelQ7, TestModelQ6, TestModel1)
+    TestModel1.objects.bulk_create([TestModel1(pk=i + 1, bar='bar%s' % (i % 10)) for i in range(rows)])
+    TestModelQ6.objects.bulk_create([
+        TestModelQ6(pk=i + 1, parent_for_6_id=i + 1, is_foo_inherited=i % 4 != 0, foo_value='own')
+        for i in range(rows)
+    ])
+    TestModelQ7.objects.bulk_create([TestModelQ7(pk=i + 1, parent_for_7_id=i + 1) for i in range(rows)])
+    TestModelQ8.objects.bulk_create([TestModelQ8(pk=i + 1, parent_for_8_id=i + 1) for i in range(rows)])
+
+CHAIN = (('TestModelQ6', 'foo'), ('TestModelQ7', 'boo'), ('TestModelQ8', 'goo'))
+
+@benchmark
+def inherited_reads():
+    "Reading inherited values of every row, by row count, chain depth and loading strategy."
+    from test_app import models
+    for rows in ROW_COUNTS:
+        make_chains(rows)
+        for depth, (model_name, name) in enumerate(CHAIN):
+            qs = getattr(models, model_name).objects.all()
+            strategies = (
+                ('lazy', qs),
+                ('resolve_inherited', qs.resolve_inherited(name)),
+                ('select_inherited', qs.select_inherited(name)),
+                ('with_inherited', qs.with_inherited(name)),
+            )
+            for strategy, strategy_qs in strategies:
+                measure('inherited_reads', '%s rows, depth %s, %s' % (rows, depth + 1, strategy),
+                        lambda: [getattr(obj, name) for obj in strategy_qs.all()], 1)
+
+@benchmark
+def inherited_filters():
+    "Filtering on inherited values, by row count and chain depth."
+    from test_app import models
+    for rows in ROW_COUNTS:
+        make_chains(rows)
+        for depth, (model_name, name) in enumerate(CHAIN):
+            qs = getattr(models, model_name).objects.all()
+            measure('inherited_filters', '%s rows, depth %s, =' % (rows, depth + 1),
+                    lambda: qs.filter(**{name: 'bar1'}).count(), 10)
+            measure('inherited_filters', '%s rows, depth %s, startswith' % (rows, depth + 1),
+                    lambda: qs.filter(**{'%s__startswith' % name: 'o'}).count(), 10)
+
+def define_model(name, attrs):
+    from django.db import models
+    attrs = dict(attrs, __module__=__name__, Meta=type('Meta', (), {'app_label': 'benchmarks'}))
+    return type(name, (models.Model,), attrs)
+
+@benchmark
+def model_registration():
+    "Cost of defining models with InheritedFields (import time of the project)."
+    from django.db import models
+    from django.db.models import signals
+    from customfields.inheritedfield import InheritedField
+    parent = define_model('RegistrationParent', {'name': models.CharField(max_length=10),
+                                                 'code': models.IntegerField()})
+    for count in (10, 100, 500):
+        start = time.time()
+        for i in range(count):
+            define_model('Registration%s_%s' % (count, i), {
+                'parent': models.ForeignKey(parent),
+                'name': InheritedField('parent'),
+                'code': InheritedField('parent'),
+            })
+        usec = (time.time() - start) / count * 1000000
+        RESULTS.append({'benchmark': 'model_registration', 'case': '%s models' % count,
+                        'usec': round(usec, 2), 'queries': 0})
+        print "    %4s models: %.1f usec/model, %s class_prepared receivers" % (
+            count, usec, len(signals.class_prepared.receivers))
+
+def compare(baseline_path):
+    "Prints the differences with the baseline, returns False if some case makes more queries."
+    with open(baseline_path) as baseline_file:
+        baseline = dict(((r['benchmark'], r['case']), r) for r in json.load(baseline_file))
+    ok = True
+    print "Compared to %s:" % baseline_path
+    for result in RESULTS:
+        old = baseline.get((result['benchmark'], result['case']))
+        if old is None:
+            continue
+        if result['queries'] > old['queries']:
+            ok = False
+            print "    MORE QUERIES %s / %s: %s -> %s" % (
+                result['benchmark'], result['case'], old['queries'], result['queries'])
+        if old['usec'] and result['usec'] / old['usec'] > SLOWER_RATIO:
+            print "    SLOWER %s / %s: %.2f -> %.2f usec" % (
+                result['benchmark'], result['case'], old['usec'], result['usec'])
+    return ok
+
+def main(args):
+    parser = OptionParser(usage="%prog [--save FILE] [--compare FILE] [name ...]")
+    parser.add_option('--save', help="Write the results (json) to FILE.")
+    parser.add_option('--compare', help="Compare the results with the ones saved in FILE.")
+    options, names = parser.parse_args(args)
+
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    settings.DEBUG = False # or else every query is kept in connection.queries
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        for func in BENCHMARKS:
+            if not names or func.__name__ in names:
+                print "%s: %s" % (func.__name__, func.__doc__)
+                func()
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    if options.save:
+        with open(options.save, 'w') as results_file:
+            json.dump(RESULTS, results_file, indent=1, sort_keys=True)
+    if options.compare and not compare(options.compare):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -21,6 +21,7 @@ class TestModelB(models.Model): # used to thest cached many to many field
 class TestModelC(models.Model): # used to thest cached many to many field
     cmtm_a = cachedmtmfield.CachedManyToManyField(TestModelA)
     cmtm_b = cachedmtmfield.CachedManyToManyField(TestModelB)
+    objects = cachedmtmfield.CachedManyToManyManager()
     
 class Stuff(models.Model):
     pass
@@ -59,4 +60,143 @@ class TestModelB(models.Model): # used to thest cached many to many field
 
 class TestModelC(models.Model): # used to thest cached many to many field
     cmtm_a = cachedmtmfield.CachedManyToManyField(TestModelA)
-    cmtm_b = cachedmtmfield.CachedManyToManyField(TestModelB)
\ No newline at end of file
+    cmtm_b = cachedmtmfield.CachedManyToManyField(TestModelB)
+    objects = cachedmtmfield.CachedManyToManyManager()
+
+class TestModelQ2(models.Model): # like TestModel2 but with the InheritedFieldManager
+    parent = models.ForeignKey(TestModel1, null=True)
+
+    bar = models.CharField(max_length=10)
+    foo = inheritedfield.InheritedField('parent', 'bar', validate=False)
+    ifoo = inheritedfield.InheritedField('parent', 'bar', inherit_only=True)
+    objects = inheritedfield.InheritedFieldManager()
+
+class TestModelQ6(models.Model): # like TestModel6/7/8 but with the InheritedFieldManager
+    parent_for_6 = models.ForeignKey(TestModel1)
+    foo = inheritedfield.InheritedField('parent_for_6', 'bar')
+    objects = inheritedfield.InheritedFieldManager()
+
+class TestModelQ7(models.Model):
+    parent_for_7 = models.ForeignKey(TestModelQ6)
+    bogus_relation = models.ForeignKey(TestModelQ6, related_name="bogus", null=True)
+    boo = inheritedfield.InheritedField('parent_for_7', 'foo')
+    objects = inheritedfield.InheritedFieldManager()
+
+class TestModelQ8(models.Model):
+    parent_for_8 = models.ForeignKey(TestModelQ7)
+    goo = inheritedfield.InheritedField('parent_for_8', 'boo')
+    objects = inheritedfield.InheritedFieldManager()
+
+class TestModelE(models.Model): # used to test the SetField codecs
+    cmtm_a = cachedmtmfield.CachedManyToManyField(TestModelA, cache_codec='varint', lazy_cache=True)
+    cmtm_b = cachedmtmfield.CachedManyToManyField(TestModelB, cache_codec='csv')
+
+class TestModelS(models.Model): # used to test the cache synchronization
+    cmtm_a = cachedmtmfield.CachedManyToManyField(TestModelA, sync_cache=True, related_name='synced')
+    cmtm_b = cachedmtmfield.CachedManyToManyField(TestModelB, autosave_cache=True, related_name='autosaved')
+
+class TestModelT(models.Model): # used to test the atomic cache updates
+    cmtm_a = cachedmtmfield.CachedManyToManyField(TestModelA, atomic_cache=True, related_name='atomic')
+
+class VisibleManager(models.Manager):
+    def get_query_set(self):
+        return super(VisibleManager, self).get_query_set().filter(hidden=False)
+
+class TestModelH(models.Model): # used to test the caches of the rows hidden by the default manager
+    hidden = models.BooleanField(default=False)
+    cmtm_a = cachedmtmfield.CachedManyToManyField(TestModelA, atomic_cache=True, related_name='hidden')
+    cmtm_b = cachedmtmfield.CachedManyToManyField(TestModelB, autosave_cache=True, related_name='hidden')
+    objects = VisibleManager()
+
+class TestModelJ(models.Model): # used to test the set lookups
+    cmtm_a = cachedmtmfield.CachedManyToManyField(TestModelA, cache_codec='json', cache_index=True,
+                                                  autosave_cache=True, related_name='json')
+    objects = cachedmtmfield.CachedManyToManyManager()
+
+class TestModelM1(models.Model): # used to test the materialized inherited fields
+    name = models.CharField(max_length=10)
+
+class TestModelM2(models.Model):
+    parent = models.ForeignKey(TestModelM1)
+    name = inheritedfield.InheritedField('parent', materialize=True)
+    objects = inheritedfield.InheritedFieldManager()
+
+class TestModelM3(models.Model):
+    parent = models.ForeignKey(TestModelM2)
+    name = inheritedfield.InheritedField('parent', materialize=True)
+    objects = inheritedfield.InheritedFieldManager()
+
+class TestModelM4(models.Model): # propagated through the journal
+    parent = models.ForeignKey(TestModelM1)
+    name = inheritedfield.InheritedField('parent', materialize=True, journal=True)
+
+class TestModelM5(models.Model): # not materialized, between materialized levels
+    parent = models.ForeignKey(TestModelM1)
+    name = inheritedfield.InheritedField('parent')
+
+class TestModelM6(models.Model):
+    parent = models.ForeignKey(TestModelM5)
+    name = inheritedfield.InheritedField('parent', materialize=True)
+    objects = inheritedfield.InheritedFieldManager()
+
+class TestModelI1(models.Model): # used to test the indexes of the inherited fields
+    parent = models.ForeignKey(TestModel1)
+    bar = inheritedfield.InheritedField('parent', index=True)
+
+class TestModelI2(models.Model):
+    parent = models.ForeignKey(TestModel1, db_index=False)
+    bar = inheritedfield.InheritedField('parent', index='partial')
+
+class TestModelMemo(models.Model): # used to test the memoized inherited fields
+    parent = models.ForeignKey(TestModelQ7)
+    boo = inheritedfield.InheritedField('parent', memoize=True)
+
+KIND_CHOICES = (
+    (1, 'one'),
+    ('Group', ((2, 'two'), (3, 'three'))),
+)
+
+class TestModelCh1(models.Model): # used to test the display of inherited choices
+    kind = models.IntegerField(choices=KIND_CHOICES, null=True) # null: the copies start empty
+
+class TestModelCh2(models.Model):
+    parent = models.ForeignKey(TestModelCh1)
+    kind = inheritedfield.InheritedField('parent')
+
+class TestModelCh3(models.Model):
+    parent = models.ForeignKey(TestModelCh2)
+    kind = inheritedfield.InheritedField('parent')
+    objects = inheritedfield.InheritedFieldManager()
+
+class TestModelCh4(models.Model):
+    parent = models.ForeignKey(TestModelCh1)
+    kind = inheritedfield.InheritedField('parent', inherit_only=True)
+
+class TestModelT1(models.Model): # used to test the types of the values computed in the database
+    day = models.DateField(null=True) # null: the copies start empty
+    flag = models.BooleanField(default=False)
+    amount = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+
+class TestModelT2(models.Model):
+    parent = models.ForeignKey(TestModelT1)
+    day = inheritedfield.InheritedField('parent')
+    flag = inheritedfield.InheritedField('parent')
+    amount = inheritedfield.InheritedField('parent')
+    objects = inheritedfield.InheritedFieldManager()
+
+class TestModelFk1(models.Model): # used to test the inherited foreign keys
+    stuff = models.ForeignKey(Stuff, null=True)
+
+class TestModelFk2(models.Model):
+    parent = models.ForeignKey(TestModelFk1)
+    stuff = inheritedfield.InheritedField('parent')
+    objects = inheritedfield.InheritedFieldManager()
+
+def get_x(obj):
+    return obj.x
+
+class TestModelBulk(models.Model): # used to test customfields.bulk
+    parent = models.ForeignKey(TestModel1, null=True)
+    bar = inheritedfield.InheritedField('parent')
+    cmtm_a = cachedmtmfield.CachedManyToManyField(TestModelA, cached_value_getter=get_x, related_name='bulk')
+    cmtm_b = cachedmtmfield.CachedManyToManyField(TestModelB, related_name='bulk')
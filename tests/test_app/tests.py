@@ -1,8 +1,39 @@
+import django
+from django.db import connection
+from django.db.models import Q
 from django.test import TestCase
+from django.utils import unittest
 from customfields.inheritedfield import InheritedOnlyException
+try:
+    from django.test.utils import CaptureQueriesContext
+except ImportError: # django < 1.6
+    class CaptureQueriesContext(object):
+        "Records the queries made in the block (like django 1.6's)."
+        def __init__(self, connection):
+            self.connection = connection
+
+        @property
+        def captured_queries(self):
+            return self.connection.queries[self.initial_queries:self.final_queries]
+
+        def __enter__(self):
+            self.use_debug_cursor = self.connection.use_debug_cursor
+            self.connection.use_debug_cursor = True
+            self.initial_queries = len(self.connection.queries)
+            self.final_queries = None
+            return self
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            self.connection.use_debug_cursor = self.use_debug_cursor
+            if exc_type is None:
+                self.final_queries = len(self.connection.queries)
         
 from models import *
 
+def sql_queries(queries):
+    "The captured queries, without the savepoints the transaction handling makes."
+    return [q['sql'] for q in queries.captured_queries if 'SAVEPOINT' not in q['sql']]
+
 class CachedManyToManyTests(TestCase):
     def test_runtime_model(self):
         d = TestModelC()
@@ -473,4 +504,997 @@ class CachedManyToManyTests(TestCase):
         c.save()
         self.assertRaises(TypeError, lambda: TestModelC.objects.filter(cmtm_a_cache=1))
         
-        
\ No newline at end of file
+        
+class SetFieldCodecTests(TestCase):
+    def test_roundtrip(self):
+        for name in ('pickle', 'csv', 'varint', 'json', 'array'):
+            sf = cachedmtmfield.SetField(codec=name)
+            for value in (set([1]), set([-5, 0, 3, 128, 300, 2 ** 40]), set(range(1000))):
+                self.assertEquals(sf.to_python(sf.get_db_prep_value(value)), value)
+
+    def test_compact(self):
+        value = set(range(1000, 2000))
+        pickled = cachedmtmfield.SetField().get_db_prep_value(value)
+        encoded = cachedmtmfield.SetField(codec='varint').get_db_prep_value(value)
+        self.assertTrue(len(encoded) * 5 < len(pickled))
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, cachedmtmfield.SetField, codec='bogus')
+
+    def test_reads_other_codecs(self):
+        sf = cachedmtmfield.SetField(codec='varint')
+        self.assertEquals(sf.to_python(cachedmtmfield.SetField().get_db_prep_value(set([1, 2]))), set([1, 2]))
+        self.assertEquals(sf.to_python("3,4"), set([3, 4]))
+
+    def test_malformed(self):
+        sf = cachedmtmfield.SetField(codec='csv')
+        for value in ('12abc', '1,,2', '?'):
+            self.assertRaises((TypeError, ValueError), sf.to_python, value)
+
+    def test_legacy_rows(self):
+        a = TestModelA.objects.create()
+        b = TestModelB.objects.create()
+        e = TestModelE.objects.create()
+        TestModelE.objects.filter(pk=e.pk).update(
+            cmtm_a_cache=cachedmtmfield.PickleCodec().encode(set([a.pk])),
+            cmtm_b_cache=cachedmtmfield.PickleCodec().encode(set([b.pk])),
+        )
+        e = TestModelE.objects.get(pk=e.pk)
+        self.assertEquals(e.cmtm_a_cache, set([a.pk]))
+        self.assertEquals(e.cmtm_b_cache, set([b.pk]))
+        e.save()
+        self.assertEquals(TestModelE.objects.values_list('cmtm_a_cache', 'cmtm_b_cache').get(pk=e.pk),
+                          (cachedmtmfield.VarintCodec().encode(set([a.pk])), str(b.pk)))
+
+class CachingRelatedManagerTests(TestCase):
+    def test_manager_class_reused(self):
+        c = TestModelC.objects.create()
+        d = TestModelC.objects.create()
+        self.assertTrue(c.cmtm_a.__class__ is d.cmtm_a.__class__)
+        self.assertTrue(c.cmtm_a.__class__ is c.cmtm_a.__class__)
+        self.assertFalse(c.cmtm_a.__class__ is c.cmtm_b.__class__)
+
+    def test_instance_state(self):
+        c = TestModelC.objects.create()
+        d = TestModelC.objects.create()
+        a = TestModelA.objects.create()
+        manager_c, manager_d = c.cmtm_a, d.cmtm_a
+        manager_d.add(a)
+        self.assertEquals(manager_c.cache, set())
+        self.assertEquals(manager_d.cache, set([a.pk]))
+
+    def test_class_access(self):
+        self.assertTrue(isinstance(TestModelC.cmtm_a, cachedmtmfield.CachedReverseManyRelatedObjectsDescriptor))
+
+class LazySetFieldTests(TestCase):
+    def test_decode_on_access(self):
+        a = TestModelA.objects.create()
+        e = TestModelE.objects.create()
+        e.cmtm_a.add(a)
+        e.save()
+        e = TestModelE.objects.get(pk=e.pk)
+        self.assertTrue(isinstance(e.__dict__['cmtm_a_cache'], cachedmtmfield.Undecoded))
+        self.assertFalse(isinstance(e.__dict__['cmtm_b_cache'], cachedmtmfield.Undecoded))
+        self.assertEquals(e.cmtm_a.cache, set([a.pk]))
+        self.assertEquals(e.__dict__['cmtm_a_cache'], set([a.pk]))
+
+    def test_untouched_saved_unchanged(self):
+        a = TestModelA.objects.create()
+        e = TestModelE.objects.create()
+        legacy = cachedmtmfield.PickleCodec().encode(set([a.pk]))
+        TestModelE.objects.filter(pk=e.pk).update(cmtm_a_cache=legacy)
+        e = TestModelE.objects.get(pk=e.pk)
+        e.save()
+        self.assertEquals(TestModelE.objects.values_list('cmtm_a_cache', flat=True).get(pk=e.pk), legacy)
+        e.cmtm_a_cache
+        e.save()
+        self.assertEquals(TestModelE.objects.values_list('cmtm_a_cache', flat=True).get(pk=e.pk),
+                          cachedmtmfield.VarintCodec().encode(set([a.pk])))
+
+    def test_new_instance(self):
+        e = TestModelE()
+        self.assertEquals(e.cmtm_a_cache, set())
+        e.cmtm_a_cache = set([1])
+        self.assertEquals(e.cmtm_a_cache, set([1]))
+
+class RebuildCacheTests(TestCase):
+    def setUp(self):
+        self.a = [TestModelA.objects.create() for i in range(3)]
+        self.c = [TestModelC.objects.create() for i in range(5)]
+        for i, c in enumerate(self.c):
+            c.cmtm_a.add(*self.a[:i])
+        TestModelC.objects.update(cmtm_a_cache=set([999]))
+
+    def check(self):
+        for i, c in enumerate(TestModelC.objects.order_by('pk')):
+            self.assertEquals(c.cmtm_a_cache, set(a.pk for a in self.a[:i]))
+
+    def test_rebuild(self):
+        pks = []
+        with CaptureQueriesContext(connection) as queries:
+            last_pk = cachedmtmfield.rebuild_cache(TestModelC, 'cmtm_a', chunk_size=2, callback=pks.append)
+        self.assertEquals(len(sql_queries(queries)), 3 * 3 + 1) # pks, through table, update per chunk
+        self.assertEquals(last_pk, self.c[-1].pk)
+        self.assertEquals(pks, [self.c[1].pk, self.c[3].pk, self.c[4].pk])
+        self.check()
+
+    def test_resume(self):
+        cachedmtmfield.rebuild_cache(TestModelC, 'cmtm_a', start_pk=self.c[2].pk)
+        self.assertEquals(TestModelC.objects.get(pk=self.c[1].pk).cmtm_a_cache, set([999]))
+        self.assertEquals(TestModelC.objects.get(pk=self.c[3].pk).cmtm_a_cache, set(a.pk for a in self.a[:3]))
+
+    def test_hidden_rows(self):
+        b = TestModelB.objects.create()
+        h = TestModelH.objects.create(hidden=True)
+        TestModelH.cmtm_b.through.objects.create(testmodelh=h, testmodelb=b)
+        cachedmtmfield.rebuild_cache(TestModelH, 'cmtm_b')
+        self.assertEquals(TestModelH._base_manager.get(pk=h.pk).cmtm_b_cache, set([b.pk]))
+
+    def test_not_cached(self):
+        self.assertRaises(TypeError, cachedmtmfield.rebuild_cache, TestModel1, 'm2mrel')
+
+    def test_command(self):
+        from django.core.management import call_command
+        call_command('rebuild_m2m_cache', 'test_app.TestModelC', 'cmtm_a', chunk_size=3, verbosity=0)
+        self.check()
+
+class SyncCacheTests(TestCase):
+    def stored(self, obj):
+        return TestModelS.objects.get(pk=obj.pk).cmtm_a_cache
+
+    def test_forward(self):
+        a, b = TestModelA.objects.create(), TestModelA.objects.create()
+        s = TestModelS.objects.create()
+        s.cmtm_a.add(a, b)
+        self.assertEquals(self.stored(s), set([a.pk, b.pk]))
+        s.cmtm_a.remove(a)
+        self.assertEquals(s.cmtm_a_cache, set([b.pk]))
+        self.assertEquals(self.stored(s), set([b.pk]))
+        TestModelS.objects.get(pk=s.pk).cmtm_a.clear()
+        self.assertEquals(self.stored(s), set())
+
+    def test_reverse(self):
+        a = TestModelA.objects.create()
+        s1, s2, s3 = [TestModelS.objects.create() for i in range(3)]
+        with CaptureQueriesContext(connection) as queries:
+            a.synced.add(s1, s2, s3)
+        self.assertEquals(len([q for q in sql_queries(queries) if 'UPDATE' in q]), 1)
+        self.assertEquals([self.stored(s) for s in (s1, s2, s3)], [set([a.pk])] * 3)
+        a.synced.remove(s2)
+        self.assertEquals([self.stored(s) for s in (s1, s2, s3)], [set([a.pk]), set(), set([a.pk])])
+        a.synced.clear()
+        self.assertEquals([self.stored(s) for s in (s1, s2, s3)], [set()] * 3)
+
+    def test_bulk_create(self):
+        a = TestModelA.objects.create()
+        s = TestModelS.objects.create()
+        through = TestModelS.cmtm_a.through
+        through.objects.bulk_create([through(testmodels=s, testmodela=a)])
+        cachedmtmfield.sync_cache(TestModelS, 'cmtm_a', [s.pk])
+        self.assertEquals(self.stored(s), set([a.pk]))
+
+class AutosaveCacheTests(TestCase):
+    def stored(self, obj):
+        return TestModelS.objects.get(pk=obj.pk).cmtm_b_cache
+
+    def test_autosave(self):
+        b1, b2 = TestModelB.objects.create(), TestModelB.objects.create()
+        s = TestModelS.objects.create()
+        with CaptureQueriesContext(connection) as queries:
+            s.cmtm_b.add(b1, b2)
+        updates = [q for q in sql_queries(queries) if 'UPDATE' in q]
+        self.assertEquals(len(updates), 1)
+        self.assertTrue('"cmtm_b_cache" = ' in updates[0])
+        self.assertFalse('"cmtm_a_cache"' in updates[0])
+        self.assertEquals(self.stored(s), set([b1.pk, b2.pk]))
+        s.cmtm_b.remove(b1)
+        self.assertEquals(self.stored(s), set([b2.pk]))
+        s.cmtm_b.clear()
+        self.assertEquals(self.stored(s), set())
+
+    def test_hidden_owner(self):
+        b = TestModelB.objects.create()
+        h = TestModelH.objects.create(hidden=True)
+        h.cmtm_b.add(b)
+        self.assertEquals(TestModelH._base_manager.get(pk=h.pk).cmtm_b_cache, set([b.pk]))
+
+    def test_no_autosave(self):
+        a = TestModelA.objects.create()
+        c = TestModelC.objects.create()
+        c.cmtm_a.add(a)
+        self.assertEquals(TestModelC.objects.get(pk=c.pk).cmtm_a_cache, set())
+
+class AtomicCacheTests(TestCase):
+    def test_stale_instances(self):
+        a1, a2, a3 = [TestModelA.objects.create() for i in range(3)]
+        t = TestModelT.objects.create()
+        t1 = TestModelT.objects.get(pk=t.pk)
+        t2 = TestModelT.objects.get(pk=t.pk)
+        t1.cmtm_a.add(a1, a3)
+        t2.cmtm_a.add(a2)
+        self.assertEquals(t2.cmtm_a_cache, set([a1.pk, a2.pk, a3.pk]))
+        t1.cmtm_a.remove(a1)
+        self.assertEquals(t1.cmtm_a_cache, set([a2.pk, a3.pk]))
+        self.assertEquals(TestModelT.objects.get(pk=t.pk).cmtm_a_cache, set([a2.pk, a3.pk]))
+
+    def test_hidden_owner(self):
+        a = TestModelA.objects.create()
+        h = TestModelH.objects.create(hidden=True)
+        h.cmtm_a.add(a)
+        self.assertEquals(TestModelH._base_manager.get(pk=h.pk).cmtm_a_cache, set([a.pk]))
+
+    def test_locks(self):
+        a = TestModelA.objects.create()
+        t = TestModelT.objects.create()
+        with CaptureQueriesContext(connection) as queries:
+            t.cmtm_a.add(a)
+        self.assertTrue('"cmtm_a_cache"' in sql_queries(queries)[0])
+
+class SetLookupTests(TestCase):
+    def setUp(self):
+        self.a = [TestModelA.objects.create() for i in range(3)]
+        self.j = [TestModelJ.objects.create() for i in range(4)]
+        self.j[1].cmtm_a.add(self.a[0])
+        self.j[2].cmtm_a.add(self.a[0], self.a[1])
+        self.j[3].cmtm_a.add(self.a[2])
+
+    def pks(self, qs):
+        return [self.j.index(j) for j in qs.order_by('pk')]
+
+    def test_json_roundtrip(self):
+        self.assertEquals(TestModelJ.objects.values_list('cmtm_a_cache', flat=True).get(pk=self.j[2].pk),
+                          '[%s,%s]' % (self.a[0].pk, self.a[1].pk))
+        self.assertEquals(TestModelJ.objects.get(pk=self.j[2].pk).cmtm_a_cache, set([self.a[0].pk, self.a[1].pk]))
+
+    def test_contains(self):
+        qs = TestModelJ.objects.filter(cmtm_a_cache__contains=[self.a[0].pk])
+        self.assertEquals(self.pks(qs), [1, 2])
+        qs = TestModelJ.objects.filter(cmtm_a_cache__contains=[self.a[0].pk, self.a[1].pk])
+        self.assertEquals(self.pks(qs), [2])
+        self.assertFalse('JOIN' in str(qs.query))
+
+    def test_overlap(self):
+        qs = TestModelJ.objects.filter(cmtm_a_cache__overlap=[self.a[1].pk, self.a[2].pk])
+        self.assertEquals(self.pks(qs), [2, 3])
+
+    def test_contained_by(self):
+        qs = TestModelJ.objects.filter(cmtm_a_cache__contained_by=[self.a[0].pk, self.a[1].pk])
+        self.assertEquals(self.pks(qs), [0, 1, 2])
+
+    def test_exclude(self):
+        qs = TestModelJ.objects.exclude(cmtm_a_cache__contains=[self.a[0].pk])
+        self.assertEquals(self.pks(qs), [0, 3])
+        qs = TestModelJ.objects.exclude(cmtm_a_cache__contains=[self.a[0].pk], pk=self.j[1].pk)
+        self.assertEquals(self.pks(qs), [0, 2, 3])
+
+    def test_q(self):
+        a0, a1, a2 = [a.pk for a in self.a]
+        qs = TestModelJ.objects.filter(Q(cmtm_a_cache__contains=[a0]))
+        self.assertEquals(self.pks(qs), [1, 2])
+        qs = TestModelJ.objects.filter(Q(cmtm_a_cache__contains=[a1]) | Q(cmtm_a_cache__contains=[a2]))
+        self.assertEquals(self.pks(qs), [2, 3])
+        qs = TestModelJ.objects.filter(~Q(cmtm_a_cache__overlap=[a0, a2]))
+        self.assertEquals(self.pks(qs), [0])
+        qs = TestModelJ.objects.exclude(Q(cmtm_a_cache__contains=[a0]) & Q(pk=self.j[1].pk))
+        self.assertEquals(self.pks(qs), [0, 2, 3])
+        self.assertEquals(TestModelJ.objects.get(Q(cmtm_a_cache__contains=[a2])), self.j[3])
+        qs = TestModelJ.objects.filter(Q(cmtm_a_cache__contains=[a0]), cmtm_a_cache__contains=[a1])
+        self.assertEquals(self.pks(qs), [2])
+
+    def test_unsupported(self):
+        self.assertRaises(TypeError, lambda: TestModelJ.objects.filter(cmtm_a_cache=1))
+        self.assertRaises(TypeError, cachedmtmfield.CommaSeparatedCodec().lookup_sql,
+                          'contains', 'column', [1], connection)
+
+class LoadCacheTests(TestCase):
+    def setUp(self):
+        self.a = [TestModelA.objects.create() for i in range(3)]
+        self.b = TestModelB.objects.create()
+        self.c = [TestModelC.objects.create() for i in range(4)]
+        for i, c in enumerate(self.c):
+            c.cmtm_a.add(*self.a[:i])
+            c.cmtm_b.add(self.b)
+
+    def test_with_m2m_cache(self):
+        with self.assertNumQueries(3):
+            objs = list(TestModelC.objects.with_m2m_cache('cmtm_a', 'cmtm_b').order_by('pk'))
+        for i, c in enumerate(objs):
+            self.assertEquals(c.cmtm_a_cache, set(a.pk for a in self.a[:i]))
+            self.assertEquals(c.cmtm_b_cache, set([self.b.pk]))
+
+    def test_batches(self):
+        old_size, cachedmtmfield.LOAD_BATCH_SIZE = cachedmtmfield.LOAD_BATCH_SIZE, 3
+        try:
+            with self.assertNumQueries(3):
+                objs = list(TestModelC.objects.filter(pk__gt=0).with_m2m_cache('cmtm_a').order_by('pk'))
+        finally:
+            cachedmtmfield.LOAD_BATCH_SIZE = old_size
+        self.assertEquals(objs[3].cmtm_a_cache, set(a.pk for a in self.a))
+
+    def test_invalid_field(self):
+        self.assertRaises(TypeError, TestModelC.objects.with_m2m_cache, 'id')
+
+class ResolveCacheTests(TestCase):
+    def setUp(self):
+        self.a = [TestModelA.objects.create() for i in range(3)]
+        self.b = TestModelB.objects.create()
+        self.c = [TestModelC.objects.create() for i in range(4)]
+        for i, c in enumerate(self.c):
+            c.cmtm_a.add(*self.a[:i])
+            c.cmtm_b.add(self.b)
+            c.save()
+
+    def test_resolve(self):
+        objs = list(TestModelC.objects.order_by('pk'))
+        with self.assertNumQueries(2):
+            identity_map = cachedmtmfield.resolve_m2m_cache(objs, ['cmtm_a', 'cmtm_b'])
+        with self.assertNumQueries(0):
+            self.assertEquals(objs[2].cmtm_a.cached_objects, self.a[:2])
+            self.assertEquals(objs[3].cmtm_b.cached_objects, [self.b])
+            self.assertTrue(objs[2].cmtm_a.cached_objects[0] is objs[3].cmtm_a.cached_objects[0])
+        with self.assertNumQueries(0):
+            cachedmtmfield.resolve_m2m_cache(objs, ['cmtm_a'], identity_map=identity_map)
+
+    def test_queryset(self):
+        with self.assertNumQueries(3):
+            objs = list(TestModelC.objects.with_m2m_objects('cmtm_a', 'cmtm_b').order_by('pk'))
+            self.assertEquals(objs[3].cmtm_a.cached_objects, self.a)
+            self.assertTrue(objs[1].cmtm_b.cached_objects[0] is objs[2].cmtm_b.cached_objects[0])
+
+    def test_single(self):
+        c = TestModelC.objects.get(pk=self.c[1].pk)
+        self.assertEquals(c.cmtm_a.cached_objects, self.a[:1])
+        c.cmtm_a.add(self.a[2])
+        self.assertEquals(c.cmtm_a.cached_objects, [self.a[0], self.a[2]])
+
+def make_chain(count=3):
+    "Makes `count` TestModel1 -> TestModelQ6 -> TestModelQ7 -> TestModelQ8 chains."
+    chains = []
+    for i in range(count):
+        a = TestModel1.objects.create(bar="bar%s" % i)
+        b = TestModelQ6.objects.create(parent_for_6=a)
+        c = TestModelQ7.objects.create(parent_for_7=b)
+        d = TestModelQ8.objects.create(parent_for_8=c)
+        chains.append((a, b, c, d))
+    return chains
+
+class ResolveInheritedTests(TestCase):
+    def test_resolve(self):
+        make_chain(3)
+        objs = list(TestModelQ8._base_manager.order_by('pk'))
+        with self.assertNumQueries(3):
+            inheritedfield.resolve_inherited(objs)
+        with self.assertNumQueries(0):
+            self.assertEquals([d.goo for d in objs], ['bar0', 'bar1', 'bar2'])
+
+    def test_only_inheriting(self):
+        chains = make_chain(2)
+        a, b, c, d = chains[0]
+        c.boo = 'override'
+        c.save()
+        objs = list(TestModelQ8._base_manager.order_by('pk'))
+        with self.assertNumQueries(3):
+            inheritedfield.resolve_inherited(objs, ['goo'])
+        self.assertEquals([d.goo for d in objs], ['override', 'bar1'])
+        self.assertFalse(hasattr(objs[0].parent_for_8, '_parent_for_7_cache'))
+
+    def test_set_drops_memo(self):
+        a, b, c, d = make_chain(1)[0]
+        d = TestModelQ8._base_manager.get(pk=d.pk)
+        inheritedfield.resolve_inherited([d])
+        d.goo = 'abc'
+        self.assertEquals(d.goo, 'abc')
+
+    def test_flag_or_parent_drops_memo(self):
+        chains = make_chain(2)
+        d = TestModelQ8._base_manager.get(pk=chains[0][3].pk)
+        inheritedfield.resolve_inherited([d], display=True)
+        self.assertEquals((d.goo, d.get_goo_display()), ('bar0', 'bar0 *Inherited *Inherited *Inherited'))
+        d.parent_for_8 = chains[1][2]
+        self.assertEquals((d.goo, d.get_goo_display()), ('bar1', 'bar1 *Inherited *Inherited *Inherited'))
+        d.is_goo_inherited = False
+        d.goo_value = 'own'
+        self.assertEquals((d.goo, d.get_goo_display()), ('own', 'own'))
+
+    def test_queryset(self):
+        make_chain(3)
+        with self.assertNumQueries(4):
+            objs = list(TestModelQ8.objects.resolve_inherited())
+            self.assertEquals(sorted(d.goo for d in objs), ['bar0', 'bar1', 'bar2'])
+
+    def test_unknown_field(self):
+        self.assertRaises(TypeError, inheritedfield.resolve_inherited, [TestModelQ8()], ['bogus'])
+
+    def test_value_field_saved(self):
+        a, b, c, d = make_chain(1)[0]
+        c.boo = 'abc'
+        c.save()
+        c = TestModelQ7.objects.get(pk=c.pk)
+        self.assertEquals((c.boo, c.boo_value, c.is_boo_inherited), ('abc', 'abc', False))
+
+class WithInheritedTests(TestCase):
+    def setUp(self):
+        self.chains = make_chain(3)
+        c = self.chains[1][2]
+        c.boo = 'override'
+        c.save()
+        d = self.chains[2][3]
+        d.goo = 'aaa'
+        d.save()
+
+    def test_values(self):
+        qs = TestModelQ8.objects.with_inherited('goo').order_by('goo_effective')
+        self.assertEquals(list(qs.values_list('goo_effective', flat=True)), ['aaa', 'bar0', 'override'])
+
+    def test_no_parent_access(self):
+        objs = list(TestModelQ8.objects.with_inherited().order_by('pk'))
+        with self.assertNumQueries(0):
+            self.assertEquals([d.goo for d in objs], ['bar0', 'override', 'aaa'])
+
+    def test_flag_drops_memo(self):
+        d = TestModelQ8.objects.with_inherited('goo').order_by('pk')[0]
+        self.assertEquals(d.goo, 'bar0')
+        d.is_goo_inherited = False
+        d.goo_value = 'own'
+        self.assertEquals(d.goo, 'own')
+        d.is_goo_inherited = True
+        self.assertEquals(d.goo, 'bar0')
+
+    def test_inherit_only(self):
+        a = TestModel1.objects.create(bar='abc')
+        b = TestModelQ2(parent=a)
+        b.foo = 'xyz'
+        b.save()
+        qs = TestModelQ2.objects.with_inherited('foo', 'ifoo')
+        self.assertEquals(list(qs.values_list('foo_effective', 'ifoo_effective')), [('xyz', 'abc')])
+
+    def test_group_by(self):
+        from django.db.models import Count
+        qs = TestModelQ7.objects.with_inherited('boo').values('boo_effective').annotate(n=Count('id')).order_by('boo_effective')
+        self.assertEquals([(row['boo_effective'], row['n']) for row in qs], [('bar0', 1), ('bar2', 1), ('override', 1)])
+
+    def test_types(self):
+        import datetime, decimal
+        parent = TestModelT1.objects.create(day=datetime.date(2020, 1, 2), flag=True, amount=decimal.Decimal('1.5'))
+        own = TestModelT2.objects.create(parent=parent)
+        own.amount = decimal.Decimal('2.25')
+        own.save()
+        TestModelT2.objects.create(parent=parent)
+        for obj in TestModelT2.objects.with_inherited().order_by('pk'):
+            self.assertEquals(obj.day, datetime.date(2020, 1, 2))
+            self.assertTrue(obj.flag is True)
+            self.assertTrue(isinstance(obj.amount, decimal.Decimal))
+            self.assertEquals(obj.amount_effective, obj.amount)
+        self.assertEquals([obj.amount for obj in TestModelT2.objects.with_inherited('amount').order_by('pk')],
+                          [decimal.Decimal('2.25'), decimal.Decimal('1.5')])
+
+class SelectInheritedTests(TestCase):
+    def test_narrow(self):
+        make_chain(2)
+        with self.assertNumQueries(1):
+            objs = list(TestModelQ8.objects.select_inherited().order_by('pk'))
+            self.assertEquals([d.goo for d in objs], ['bar0', 'bar1'])
+        self.assertTrue(objs[0].parent_for_8._deferred)
+        sql = str(TestModelQ8.objects.select_inherited().query)
+        self.assertFalse('bogus_relation_id' in sql)
+        self.assertTrue('"test_app_testmodelq8"."goo_value"' in sql)
+
+    def test_per_field(self):
+        a = TestModel1.objects.create(bar='abc')
+        b = TestModelQ2.objects.create(parent=a)
+        qs = TestModelQ2.objects.all()
+        self.assertEquals(inheritedfield.get_inheritance_columns(TestModelQ2, ['ifoo']),
+                          set(['id', 'parent', 'bar', 'is_foo_inherited', 'foo_value', 'parent__bar']))
+        with self.assertNumQueries(1):
+            self.assertEquals(qs.select_inherited('ifoo')[0].ifoo, 'abc')
+
+    def test_no_joins_for_aggregates(self):
+        make_chain(2)
+        from django.db.models import Max
+        qs = TestModelQ8.objects.select_inherited()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEquals(qs.count(), 2)
+            self.assertTrue(qs.exists())
+            qs.aggregate(Max('id'))
+        for sql in sql_queries(queries):
+            self.assertFalse('JOIN' in sql)
+
+class MaterializedTests(TestCase):
+    def setUp(self):
+        self.m1 = TestModelM1.objects.create(name='abc')
+        self.m2 = [TestModelM2.objects.create(parent=self.m1) for i in range(3)]
+        self.m2[2].name = 'override'
+        self.m2[2].save()
+        self.m3 = [TestModelM3.objects.create(parent=m2) for m2 in self.m2]
+
+    def names(self, model):
+        return list(model.objects.order_by('pk').values_list('name_value', flat=True))
+
+    def test_saved(self):
+        self.assertEquals(self.names(TestModelM2), ['abc', 'abc', 'override'])
+        self.assertEquals(self.names(TestModelM3), ['abc', 'abc', 'override'])
+
+    def test_no_parent_access(self):
+        objs = list(TestModelM3.objects.order_by('pk'))
+        with self.assertNumQueries(0):
+            self.assertEquals([m3.name for m3 in objs], ['abc', 'abc', 'override'])
+
+    def test_propagate(self):
+        self.m1.name = 'xyz'
+        with CaptureQueriesContext(connection) as queries:
+            self.m1.save()
+        self.assertEquals(len([q for q in sql_queries(queries) if 'UPDATE' in q]), 3) # m1, m2 level, m3 level
+        self.assertEquals(self.names(TestModelM2), ['xyz', 'xyz', 'override'])
+        self.assertEquals(self.names(TestModelM3), ['xyz', 'xyz', 'override'])
+
+    @unittest.skipIf(django.VERSION < (1, 5), "save(update_fields) is new in django 1.5")
+    def test_update_fields(self):
+        self.m1.name = 'xyz'
+        self.m1.save(update_fields=['name'])
+        self.assertEquals(self.names(TestModelM3), ['xyz', 'xyz', 'override'])
+        m2 = TestModelM2.objects.get(pk=self.m2[0].pk)
+        with CaptureQueriesContext(connection) as queries:
+            m2.save(update_fields=['name_value'])
+        self.assertEquals(len([q for q in sql_queries(queries) if 'UPDATE' in q]), 2)
+
+    def test_propagate_api(self):
+        TestModelM1.objects.filter(pk=self.m1.pk).update(name='xyz')
+        inheritedfield.propagate_inherited(TestModelM1, [self.m1.pk])
+        self.assertEquals(self.names(TestModelM3), ['xyz', 'xyz', 'override'])
+
+    def test_plain_level(self):
+        m5 = [TestModelM5.objects.create(parent=self.m1) for i in range(2)]
+        m5[1].name = 'override'
+        m5[1].save()
+        for parent in m5:
+            TestModelM6.objects.create(parent=parent)
+        self.m1.name = 'xyz'
+        self.m1.save()
+        self.assertEquals(self.names(TestModelM6), ['xyz', 'override'])
+        self.assertEquals(TestModelM6.objects.filter(name='xyz').count(), 1)
+        m5[1].is_name_inherited = True
+        m5[1].save()
+        self.assertEquals(self.names(TestModelM6), ['xyz', 'xyz'])
+
+    def test_reset(self):
+        m2 = TestModelM2.objects.get(pk=self.m2[2].pk)
+        m2.is_name_inherited = True
+        m2.save()
+        self.assertEquals(self.names(TestModelM2), ['abc', 'abc', 'abc'])
+        self.assertEquals(self.names(TestModelM3), ['abc', 'abc', 'abc'])
+
+    def test_with_inherited(self):
+        qs = TestModelM3.objects.with_inherited('name')
+        self.assertFalse('inherited_0' in str(qs.query))
+
+    def test_inherit_only(self):
+        self.assertRaises(TypeError, inheritedfield.InheritedField, 'parent', inherit_only=True, materialize=True)
+
+class JournalTests(TestCase):
+    def setUp(self):
+        from customfields.models import InheritanceJournal
+        self.journal = InheritanceJournal.objects
+        self.m1 = [TestModelM1.objects.create(name='abc') for i in range(2)]
+        self.m2 = TestModelM2.objects.create(parent=self.m1[0])
+        self.m4 = [TestModelM4.objects.create(parent=m1) for m1 in self.m1 * 2]
+
+    def names(self):
+        return list(TestModelM4.objects.order_by('pk').values_list('name_value', flat=True))
+
+    def test_journal_field_requires_materialize(self):
+        self.assertRaises(TypeError, inheritedfield.InheritedField, 'parent', journal=True)
+
+    def test_deferred(self):
+        self.m1[0].name = 'xyz'
+        self.m1[0].save()
+        self.assertEquals(TestModelM2.objects.get().name_value, 'xyz') # not journaled
+        self.assertEquals(self.names(), ['abc'] * 4)
+        self.assertEquals(self.journal.count(), 1)
+        self.assertEquals(inheritedfield.drain_journal(), 1)
+        self.assertEquals(self.names(), ['xyz', 'abc', 'xyz', 'abc'])
+        self.assertEquals(self.journal.count(), 0)
+
+    def test_coalesce(self):
+        for name in ('x', 'y', 'z'):
+            for m1 in self.m1:
+                m1.name = name
+                m1.save()
+        self.assertEquals(self.journal.count(), 6)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEquals(inheritedfield.drain_journal(), 6)
+        self.assertEquals(len([q for q in sql_queries(queries) if 'UPDATE' in q]), 1)
+        self.assertEquals(self.names(), ['z'] * 4)
+
+    def test_batches(self):
+        for m1 in self.m1:
+            m1.name = 'xyz'
+            m1.save()
+        batches = []
+        inheritedfield.drain_journal(batch_size=1, callback=batches.append)
+        self.assertEquals(batches, [1, 1])
+        self.assertEquals(self.names(), ['xyz'] * 4)
+
+    def test_uninstalled_model(self):
+        self.journal.create(model='gone.Model', object_pk='1')
+        self.m1[0].name = 'xyz'
+        self.m1[0].save()
+        self.assertEquals(inheritedfield.drain_journal(), 2)
+        self.assertEquals(self.names(), ['xyz', 'abc', 'xyz', 'abc'])
+        self.assertEquals(self.journal.count(), 0)
+
+    @unittest.skipIf(django.VERSION < (1, 5), "save(update_fields) is new in django 1.5")
+    def test_update_fields(self):
+        self.m1[0].save(update_fields=['name'])
+        self.assertEquals(self.journal.get().update_fields, 'name')
+
+    def test_command(self):
+        from django.core.management import call_command
+        self.m1[1].name = 'xyz'
+        self.m1[1].save()
+        call_command('drain_inheritance_journal', verbosity=0)
+        self.assertEquals(self.names(), ['abc', 'xyz', 'abc', 'xyz'])
+
+class InheritanceGraphTests(TestCase):
+    def test_nodes(self):
+        node = inheritedfield.get_inheritance_node(TestModelQ8, 'goo')
+        self.assertEquals(node.path, ('parent_for_8', 'parent_for_7', 'parent_for_6'))
+        self.assertEquals(node.parent_model, TestModelQ7)
+        self.assertEquals(node.target_name, 'boo')
+        self.assertEquals(node.parent_node.field, inheritedfield.get_inherited_fields(TestModelQ7, ['boo'])[0])
+        self.assertEquals(node.terminal_model, TestModel1)
+        self.assertEquals(node.terminal_field, TestModel1._meta.get_field('bar'))
+
+    def test_compiled_once(self):
+        graph = inheritedfield.get_inheritance_graph(TestModelQ8)
+        self.assertTrue(inheritedfield.get_inheritance_graph(TestModelQ8) is graph)
+
+    def test_unknown_field(self):
+        self.assertRaises(TypeError, inheritedfield.get_inheritance_node, TestModelQ8, 'bar')
+
+    def test_traverse_related(self):
+        qs = TestModelQ8.objects.all()
+        self.assertTrue(qs.is_inherited(['parent_for_8', 'boo']))
+        self.assertFalse(qs.is_inherited(['parent_for_8', 'bogus_relation']))
+
+class RegistrationTests(TestCase):
+    def test_no_receiver_per_field(self):
+        from django.db.models import signals
+        receivers = len(signals.class_prepared.receivers)
+        class TestModel_Registration(models.Model):
+            parent = models.ForeignKey(TestModel1)
+            bar = inheritedfield.InheritedField('parent')
+        self.assertEquals(len(signals.class_prepared.receivers), receivers)
+        self.assertFalse(TestModel_Registration in inheritedfield._pending_fields)
+        self.assertEquals(TestModel_Registration._meta.get_field('bar_value').max_length, 10)
+
+    def test_clone_field(self):
+        field = TestModel1._meta.get_field('bar')
+        clone = inheritedfield.clone_field(field)
+        self.assertFalse(clone.validators is field.validators)
+        field = TestModelQ6._meta.get_field('parent_for_6')
+        clone = inheritedfield.clone_field(field)
+        self.assertFalse(clone.rel is field.rel)
+        self.assertTrue(clone.rel.to is TestModel1)
+
+class InheritedFilterTests(TestCase):
+    def setUp(self):
+        self.chains = make_chain(3)
+        a, b, c, d = self.chains[1]
+        c.boo = 'own' # overrides it for d too
+        c.save()
+        a, b, c, d = self.chains[2]
+        d.goo = 'bar0'
+        d.save()
+
+    def pks(self, qs):
+        return sorted(obj.pk for obj in qs)
+
+    def ds(self, *indexes):
+        return sorted(self.chains[i][3].pk for i in indexes)
+
+    def test_branches(self):
+        self.assertEquals(inheritedfield.get_lookup_branches(TestModelQ6, 'foo__startswith'), [
+            ((('is_foo_inherited', False),), 'foo_value__startswith'),
+            ((('is_foo_inherited', True),), 'parent_for_6__bar__startswith'),
+        ])
+        self.assertEquals(len(inheritedfield.get_lookup_branches(TestModelQ8, 'goo')), 4)
+        self.assertEquals(inheritedfield.get_lookup_branches(TestModelQ8, 'parent_for_8__bogus_relation'), None)
+        self.assertTrue(inheritedfield.get_lookup_branches(TestModelQ8, 'goo') is
+                        inheritedfield.get_lookup_branches(TestModelQ8, 'goo'))
+
+    def test_multi_level(self):
+        self.assertEquals(self.pks(TestModelQ8.objects.filter(goo='bar0')), self.ds(0, 2))
+        self.assertEquals(self.pks(TestModelQ8.objects.filter(goo='own')), self.ds(1))
+        self.assertEquals(self.pks(TestModelQ8.objects.filter(goo__startswith='bar')), self.ds(0, 2))
+        self.assertEquals(self.pks(TestModelQ8.objects.filter(goo='bar2')), [])
+
+    def test_related_lookup(self):
+        self.assertEquals(self.pks(TestModelQ8.objects.filter(parent_for_8__boo='own')), self.ds(1))
+
+    def test_q_objects(self):
+        self.assertEquals(self.pks(TestModelQ8.objects.filter(Q(goo='own') | Q(goo='bar2'))), self.ds(1))
+        self.assertEquals(self.pks(TestModelQ8.objects.filter(Q(goo='bar0'), ~Q(pk=self.chains[0][3].pk))),
+                          self.ds(2))
+
+    def test_exclude(self):
+        self.assertEquals(self.pks(TestModelQ8.objects.exclude(goo='bar0')), self.ds(1))
+        self.assertEquals(self.pks(TestModelQ8.objects.exclude(Q(goo='own') | Q(goo__endswith='2'))), self.ds(0, 2))
+
+    def test_get(self):
+        self.assertEquals(TestModelQ8.objects.get(goo='own').pk, self.chains[1][3].pk)
+
+    def test_materialized(self):
+        m1 = TestModelM1.objects.create(name='abc')
+        m3 = TestModelM3.objects.create(parent=TestModelM2.objects.create(parent=m1))
+        self.assertEquals(inheritedfield.get_lookup_branches(TestModelM3, 'name'), [((), 'name_value')])
+        self.assertEquals(list(TestModelM3.objects.filter(name='abc')), [m3])
+
+class InheritedIndexTests(TestCase):
+    def indexes(self, model):
+        cursor = connection.cursor()
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = %s", [model._meta.db_table])
+        return [row[0] for row in cursor.fetchall() if row[0]]
+
+    def test_invalid(self):
+        self.assertRaises(TypeError, inheritedfield.InheritedField, 'parent', index='bogus')
+        self.assertRaises(TypeError, inheritedfield.InheritedField, 'parent', inherit_only=True, index=True)
+
+    def test_index_together(self):
+        if hasattr(TestModelI1._meta, 'index_together'):
+            self.assertEquals(TestModelI1._meta.index_together, [('is_bar_inherited', 'bar_value')])
+            self.assertEquals(inheritedfield.inherited_index_sql(TestModelI1, connection), [])
+        else: # django < 1.5
+            self.assertEquals(inheritedfield.inherited_index_sql(TestModelI1, connection), [
+                'CREATE INDEX IF NOT EXISTS "test_app_testmodeli1_bar_value_inherited" ON "test_app_testmodeli1" '
+                '("is_bar_inherited", "bar_value")',
+            ])
+        self.assertTrue([sql for sql in self.indexes(TestModelI1) if '"is_bar_inherited", "bar_value"' in sql])
+
+    def test_partial(self):
+        self.assertEquals(getattr(TestModelI2._meta, 'index_together', []), [])
+        self.assertEquals(inheritedfield.inherited_index_sql(TestModelI2, connection), [
+            'CREATE INDEX IF NOT EXISTS "test_app_testmodeli2_parent_id" ON "test_app_testmodeli2" ("parent_id")',
+            'CREATE INDEX IF NOT EXISTS "test_app_testmodeli2_bar_value_own" ON "test_app_testmodeli2" '
+            '("is_bar_inherited", "bar_value")', # no partial indexes on sqlite
+        ])
+        indexes = self.indexes(TestModelI2)
+        for sql in inheritedfield.inherited_index_sql(TestModelI2, connection):
+            self.assertTrue(sql.replace(' IF NOT EXISTS', '') in indexes, (sql, indexes))
+
+class MemoizeTests(TestCase):
+    def setUp(self):
+        self.chains = make_chain(2)
+        self.obj = TestModelMemo.objects.create(parent=self.chains[0][2])
+        self.obj = TestModelMemo.objects.get(pk=self.obj.pk)
+
+    def test_memoized(self):
+        self.assertEquals(self.obj.boo, 'bar0')
+        display = self.obj.get_boo_display()
+        self.obj.parent.boo = 'changed' # not seen
+        self.assertEquals(self.obj.boo, 'bar0')
+        self.assertEquals(self.obj.get_boo_display(), display)
+        inheritedfield.forget_inherited(self.obj)
+        self.assertEquals(self.obj.boo, 'changed')
+
+    def test_reads(self):
+        self.obj.boo
+        self.obj.get_boo_display()
+        del self.obj._parent_cache
+        with self.assertNumQueries(0):
+            self.assertEquals(self.obj.boo, 'bar0')
+            self.obj.get_boo_display()
+
+    def test_parent_change(self):
+        self.assertEquals(self.obj.boo, 'bar0')
+        self.obj.get_boo_display()
+        self.obj.parent = self.chains[1][2]
+        self.assertEquals(self.obj.boo, 'bar1')
+        self.assertTrue(self.obj.get_boo_display().startswith('bar1 '))
+
+    def test_flag_change(self):
+        self.assertEquals(self.obj.boo, 'bar0')
+        self.obj.boo_value = 'own'
+        self.obj.is_boo_inherited = False
+        self.assertEquals(self.obj.boo, 'own')
+        self.obj.is_boo_inherited = True
+        self.assertEquals(self.obj.boo, 'bar0')
+
+    def test_set(self):
+        self.obj.get_boo_display()
+        self.obj.boo = 'own'
+        self.assertEquals(self.obj.boo, 'own')
+        self.assertEquals(self.obj.get_boo_display(), 'own')
+
+class DisplayTests(TestCase):
+    def setUp(self):
+        for kind in (1, 2, 3):
+            ch2 = TestModelCh2.objects.create(parent=TestModelCh1.objects.create(kind=kind))
+            TestModelCh3.objects.create(parent=ch2)
+            own = TestModelCh3.objects.create(parent=ch2)
+            own.kind = 1
+            own.save()
+
+    def displays(self, objs):
+        return [obj.get_kind_display() for obj in objs]
+
+    def test_display(self):
+        objs = TestModelCh3._base_manager.order_by('pk')
+        self.assertEquals(self.displays(objs), [
+            'one *Inherited *Inherited', 'one *Inherited *Inherited',
+            'two *Inherited *Inherited', 'one',
+            'three *Inherited *Inherited', 'one',
+        ])
+        self.assertEquals(TestModelCh2.objects.get(parent__kind=2).get_kind_display(), 'two *Inherited')
+
+    def test_inherit_only(self):
+        obj = TestModelCh4.objects.create(parent=TestModelCh1.objects.get(kind=2))
+        self.assertEquals(obj.get_kind_display(), 'two *Inherited')
+
+    def test_bulk(self):
+        with self.assertNumQueries(2): # TestModelCh2's patched manager joins TestModelCh1
+            objs = list(TestModelCh3.objects.resolve_inherited(display=True).order_by('pk'))
+        with self.assertNumQueries(0):
+            self.assertEquals(self.displays(objs)[2:4], ['two *Inherited *Inherited', 'one'])
+            self.assertEquals([obj.kind for obj in objs], [1, 1, 2, 1, 3, 1])
+
+    def test_set(self):
+        obj = list(TestModelCh3.objects.resolve_inherited(display=True).order_by('pk'))[2]
+        obj.kind = 3
+        self.assertEquals(obj.get_kind_display(), 'three')
+
+class SetInheritedTests(TestCase):
+    def setUp(self):
+        self.chains = make_chain(3)
+
+    def rows(self, model):
+        return list(model.objects.order_by('pk').values_list('is_foo_inherited', 'foo_value'))
+
+    def test_set(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEquals(TestModelQ6.objects.set_inherited(foo='bar1'), 3)
+        self.assertEquals(len(sql_queries(queries)), 1)
+        self.assertEquals(self.rows(TestModelQ6), [(False, 'bar1'), (True, 'bar1'), (False, 'bar1')])
+        self.assertEquals([obj.goo for obj in TestModelQ8.objects.order_by('pk')], ['bar1', 'bar1', 'bar1'])
+
+    def test_filtered(self):
+        self.assertEquals(TestModelQ6.objects.filter(foo='bar2').set_inherited(foo='own'), 1)
+        self.assertEquals(self.rows(TestModelQ6)[2], (False, 'own'))
+        self.assertEquals(TestModelQ6.objects.filter(foo='own').count(), 1)
+        self.assertEquals(TestModelQ6.objects.filter(foo='bar0').count(), 1)
+
+    def test_reset(self):
+        TestModelQ6.objects.set_inherited(foo='own')
+        self.assertEquals(TestModelQ6.objects.filter(foo='own').count(), 3)
+        self.assertEquals(TestModelQ6.objects.exclude(pk=self.chains[0][1].pk).reset_inherited('foo'), 2)
+        self.assertEquals([obj.foo for obj in TestModelQ6.objects.order_by('pk')], ['own', 'bar1', 'bar2'])
+
+    def test_invalid(self):
+        self.assertRaises(InheritedOnlyException, TestModelQ2.objects.set_inherited, ifoo='x')
+        self.assertRaises(TypeError, TestModelQ6.objects.set_inherited, bogus='x')
+
+    def test_foreign_key(self):
+        stuff = [Stuff.objects.create() for i in range(2)]
+        parent = TestModelFk1.objects.create(stuff=stuff[0])
+        child = TestModelFk2.objects.create(parent=parent)
+        self.assertEquals(TestModelFk2.objects.set_inherited(stuff=stuff[1]), 1)
+        child = TestModelFk2.objects.get(pk=child.pk)
+        self.assertEquals((child.stuff, child.is_stuff_inherited), (stuff[1], False))
+        TestModelFk2.objects.set_inherited(stuff=stuff[0].pk)
+        self.assertTrue(TestModelFk2.objects.get(pk=child.pk).is_stuff_inherited)
+
+    def test_materialized(self):
+        m1 = TestModelM1.objects.create(name='abc')
+        m2 = [TestModelM2.objects.create(parent=m1) for i in range(2)]
+        m3 = TestModelM3.objects.create(parent=m2[0])
+        qs = TestModelM2.objects.all()
+        qs.set_inherited(name='xyz')
+        self.assertEquals(TestModelM3.objects.get().name, 'xyz')
+        qs.filter(pk=m2[0].pk).reset_inherited('name')
+        self.assertEquals(TestModelM3.objects.get().name, 'abc')
+        self.assertEquals(list(qs.order_by('pk').values_list('name_value', 'is_name_inherited')),
+                          [('abc', True), ('xyz', False)])
+
+class BulkCreateTests(TestCase):
+    def setUp(self):
+        self.parents = [TestModel1.objects.create(bar='bar%s' % i) for i in range(2)]
+        self.a = [TestModelA.objects.create(x=x) for x in 'xyz']
+        self.b = [TestModelB.objects.create() for i in range(3)]
+
+    def test_inherited(self):
+        from customfields.bulk import bulk_create
+        objs = [TestModelBulk(pk=i + 1, parent_id=self.parents[i % 2].pk) for i in range(6)]
+        objs[1].bar_value = 'own'
+        objs[2].bar_value = 'bar0'
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEquals(bulk_create(TestModelBulk, objs), 6)
+        self.assertEquals(len(sql_queries(queries)), 2) # the parents, the insert
+        rows = list(TestModelBulk.objects.order_by('pk').values_list('is_bar_inherited', 'bar_value'))
+        self.assertEquals([flag for flag, value in rows], [True, False, True, True, True, True])
+        self.assertEquals([obj.bar for obj in TestModelBulk.objects.order_by('pk')],
+                          ['bar0', 'own', 'bar0', 'bar1', 'bar0', 'bar1'])
+
+    def test_memberships(self):
+        from customfields.bulk import bulk_create
+        objs = [TestModelBulk(pk=i + 1) for i in range(4)]
+        memberships = [
+            {'cmtm_a': [self.a[0], self.a[1].pk], 'cmtm_b': [self.b[0]]},
+            None,
+            {'cmtm_a': [self.a[2].pk]},
+            {'cmtm_b': [b.pk for b in self.b]},
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            bulk_create(TestModelBulk, objs, memberships)
+        # targets for the getter, owners, cmtm_a through rows, cmtm_b through rows
+        self.assertEquals(len(sql_queries(queries)), 4)
+        objs = list(TestModelBulk.objects.order_by('pk'))
+        self.assertEquals([obj.cmtm_a_cache for obj in objs], [set(['x', 'y']), set(), set(['z']), set()])
+        self.assertEquals([obj.cmtm_b_cache for obj in objs],
+                          [set([self.b[0].pk]), set(), set(), set(b.pk for b in self.b)])
+        self.assertEquals([sorted(a.pk for a in obj.cmtm_a.all()) for obj in objs],
+                          [[self.a[0].pk, self.a[1].pk], [], [self.a[2].pk], []])
+        self.assertEquals(objs[3].cmtm_b.count(), 3)
+
+    def test_batches(self):
+        from customfields.bulk import bulk_create
+        batches = []
+        objs = (TestModelBulk(pk=i + 1) for i in range(5))
+        memberships = ({'cmtm_b': [self.b[i % 3]]} for i in range(5))
+        bulk_create(TestModelBulk, objs, memberships, batch_size=2, callback=batches.append)
+        self.assertEquals([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEquals(TestModelBulk.cmtm_b.through.objects.count(), 5)
+
+    def test_needs_pks(self):
+        from customfields.bulk import bulk_create
+        self.assertRaises(TypeError, bulk_create, TestModelBulk, [TestModelBulk()], [{'cmtm_b': [self.b[0]]}])
+        self.assertEquals(bulk_create(TestModelBulk, [TestModelBulk()]), 1)
+
+class InstrumentationTests(TestCase):
+    def test_disabled(self):
+        from customfields import instrumentation
+        self.assertEquals(instrumentation.get_backend(), None)
+        make_chain(1)
+        TestModelQ8.objects.get().goo
+
+    def test_inherited(self):
+        from customfields import instrumentation
+        make_chain(1)
+        obj = TestModelQ8.objects.get()
+        with instrumentation.recording() as stats:
+            self.assertEquals(obj.goo, 'bar0')
+            self.assertEquals(obj.goo, 'bar0')
+        self.assertEquals(instrumentation.get_backend(), None)
+        self.assertEquals(stats.counters['customfields.inherited.test_app.TestModelQ8.goo.hit'], 2)
+        self.assertEquals(stats.counters['customfields.inherited.test_app.TestModelQ7.boo.hit'], 2)
+        # the parents are loaded by the first read only
+        self.assertEquals(stats.counters['customfields.inherited.test_app.TestModelQ8.goo.parent_load'], 1)
+        self.assertEquals(stats.counters['customfields.inherited.test_app.TestModelQ6.foo.parent_load'], 1)
+        self.assertEquals(len(stats.timings['customfields.inherited.test_app.TestModelQ7.boo.parent_load']), 1)
+
+    def test_setfield(self):
+        from customfields import instrumentation
+        a = TestModelA.objects.create()
+        c = TestModelC.objects.create()
+        with instrumentation.recording() as stats:
+            c.cmtm_a.add(a)
+            c.save()
+            TestModelC.objects.get(pk=c.pk)
+        name = 'customfields.setfield.test_app.TestModelC.cmtm_a_cache'
+        self.assertEquals(stats.counters[name + '.encode'], 1)
+        self.assertEquals(stats.counters[name + '.decode'], 1)
+        self.assertEquals(stats.counters[name + '.encode.bytes'], len(TestModelC.objects.filter(
+            pk=c.pk).values_list('cmtm_a_cache', flat=True)[0]))
+        self.assertEquals(stats.counters[name + '.encode.bytes'], stats.counters[name + '.decode.bytes'])
+        self.assertEquals(len(stats.timings[name + '.decode']), 1)
+
+    def test_cache_operations(self):
+        from customfields import instrumentation
+        a = [TestModelA.objects.create() for i in range(3)]
+        c = TestModelC.objects.create()
+        with instrumentation.recording() as stats:
+            c.cmtm_a.add(*a)
+            c.cmtm_a.remove(a[0])
+            c.cmtm_a.clear()
+        name = 'customfields.cachedm2m.test_app.TestModelC.cmtm_a'
+        self.assertEquals(stats.counters[name + '.add'], 3)
+        self.assertEquals(stats.counters[name + '.remove'], 1)
+        self.assertEquals(stats.counters[name + '.clear'], 1)
@@ -21,6 +21,7 @@ INSTALLED_APPS = (
     'django.contrib.contenttypes', 
     'django.contrib.sessions', 
     'django.contrib.sites',
+    'customfields',
     'test_app',
 )
 SITE_ID = 1